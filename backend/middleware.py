@@ -0,0 +1,272 @@
+"""ASGI middlewares: rate limiting, response compression and request metrics.
+
+server.py reads their configuration from the environment and adds them to
+the app; limits, bucket stores and metric objects are passed in, so nothing
+here reaches back into the server module.
+"""
+import json
+import logging
+import math
+import time
+import zlib
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from contextvars import ContextVar
+from typing import Dict, List, Optional, Tuple
+
+from starlette.responses import Response
+from starlette.routing import Match
+
+from metrics import Counter, Gauge, Histogram
+
+# brotli is optional; without it responses are only gzip-compressed
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimitStore(ABC):
+    """Token-bucket backend; implementations must update a bucket atomically."""
+
+    @abstractmethod
+    async def hit(self, key: str, capacity: int, refill_per_sec: float) -> float:
+        """Take one token from `key`'s bucket; returns 0 if allowed, else seconds until one is available."""
+
+
+class MemoryRateLimitStore(RateLimitStore):
+    """Per-worker buckets, LRU-bounded to `maxsize` keys."""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._buckets: "OrderedDict[str, Tuple[float, float]]" = OrderedDict()
+
+    async def hit(self, key: str, capacity: int, refill_per_sec: float) -> float:
+        now = time.monotonic()
+        tokens, updated = self._buckets.get(key, (float(capacity), now))
+        tokens = min(float(capacity), tokens + (now - updated) * refill_per_sec)
+        if tokens >= 1:
+            wait = 0.0
+            tokens -= 1
+        else:
+            wait = (1 - tokens) / refill_per_sec
+        self._buckets[key] = (tokens, now)
+        self._buckets.move_to_end(key)
+        while len(self._buckets) > self.maxsize:
+            self._buckets.popitem(last=False)
+        return wait
+
+
+class RateLimitMiddleware:
+    """Applies `limits` ({(method, path): (requests, seconds)}); over-limit requests get 429 + Retry-After.
+
+    Clients are told apart by the `key_header` entry `trusted_hops` from the
+    right (X-Forwarded-For style lists), or by the socket address without one.
+    """
+
+    def __init__(self, app, limits: Dict[Tuple[str, str], Tuple[int, float]], store: RateLimitStore,
+                 key_header: str = "", trusted_hops: int = 1):
+        self.app = app
+        self.limits = limits
+        self.store = store
+        self.key_header = key_header
+        self.trusted_hops = trusted_hops
+
+    def client_key(self, scope) -> str:
+        if self.key_header:
+            hops: List[str] = []
+            for name, value in scope.get("headers", []):
+                if name.decode("latin-1") == self.key_header:
+                    # Repeated headers count as one comma separated list
+                    hops.extend(h.strip() for h in value.decode("latin-1").split(","))
+            hops = [h for h in hops if h]
+            if hops:
+                # X-Forwarded-For style lists: the first hops are whatever the
+                # client sent, so take the one our trusted proxy appended
+                return hops[-min(self.trusted_hops, len(hops))]
+        client = scope.get("client")
+        return client[0] if client else "unknown"
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        path = scope["path"].rstrip("/") or "/"
+        limit = self.limits.get((scope["method"], path))
+        if limit is None:
+            return await self.app(scope, receive, send)
+
+        capacity, seconds = limit
+        # Same bucket with or without a trailing slash
+        key = f"{scope['method']} {path}|{self.client_key(scope)}"
+        try:
+            wait = await self.store.hit(key, capacity, capacity / seconds)
+        except Exception as e:
+            # Fail open: a broken limiter must not take the site down
+            logger.warning("Rate limit store error: %s", e)
+            wait = 0.0
+        if wait <= 0:
+            return await self.app(scope, receive, send)
+
+        response = Response(
+            content=json.dumps({"detail": "rate limit exceeded"}),
+            status_code=429,
+            media_type="application/json",
+            headers={"Retry-After": str(math.ceil(wait)), "X-RateLimit-Limit": f"{capacity}/{seconds:g}s"},
+        )
+        await response(scope, receive, send)
+
+
+COMPRESSIBLE_TYPES = ("application/json", "application/x-ndjson", "text/csv", "text/plain", "text/html")
+
+
+def _accepted_encoding(scope) -> Optional[str]:
+    for name, value in scope["headers"]:
+        if name == b"accept-encoding":
+            accepted = {token.split(";")[0].strip() for token in value.decode("latin-1").lower().split(",")}
+            if brotli is not None and "br" in accepted:
+                return "br"
+            if "gzip" in accepted:
+                return "gzip"
+    return None
+
+
+class _Compressor:
+    def __init__(self, encoding: str, gzip_level: int, brotli_quality: int):
+        if encoding == "br":
+            self._c = brotli.Compressor(quality=brotli_quality)
+            self.compress, self._finish = self._c.process, self._c.finish
+        else:
+            # wbits 31 = gzip container
+            self._c = zlib.compressobj(gzip_level, zlib.DEFLATED, 31)
+            self.compress, self._finish = self._c.compress, self._c.flush
+
+    def finish(self) -> bytes:
+        return self._finish()
+
+
+class CompressionMiddleware:
+    """Compresses JSON/NDJSON/CSV responses; streamed exports are compressed on the fly.
+
+    Bodies under `minimum_size` bytes and anything outside COMPRESSIBLE_TYPES
+    (notably SSE, which a compressor would buffer) pass through untouched.
+    """
+
+    def __init__(self, app, minimum_size: int = 1024, gzip_level: int = 6, brotli_quality: int = 4):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        encoding = _accepted_encoding(scope)
+        if encoding is None:
+            return await self.app(scope, receive, send)
+
+        start = None
+        compressor: Optional[_Compressor] = None
+        passthrough = False
+
+        async def send_wrapper(message):
+            nonlocal start, compressor, passthrough
+            if passthrough:
+                return await send(message)
+            if message["type"] == "http.response.start":
+                start = message
+                headers = {k.lower(): v for k, v in message["headers"]}
+                content_type = headers.get(b"content-type", b"").decode("latin-1")
+                if (b"content-encoding" in headers or message["status"] in (204, 304)
+                        or not content_type.startswith(COMPRESSIBLE_TYPES)):
+                    passthrough = True
+                    await send(start)
+                return
+
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if compressor is None:
+                if not more_body and len(body) < self.minimum_size:
+                    passthrough = True
+                    await send(start)
+                    return await send(message)
+                compressor = _Compressor(encoding, self.gzip_level, self.brotli_quality)
+                headers = [(k, v) for k, v in start["headers"] if k.lower() not in (b"content-length", b"etag")]
+                for k, v in start["headers"]:
+                    # The compressed bytes differ, so the validator becomes weak
+                    if k.lower() == b"etag" and not v.startswith(b"W/"):
+                        headers.append((k, b"W/" + v))
+                    elif k.lower() == b"etag":
+                        headers.append((k, v))
+                headers += [(b"content-encoding", encoding.encode()), (b"vary", b"Accept-Encoding")]
+                if not more_body:
+                    data = compressor.compress(body) + compressor.finish()
+                    headers.append((b"content-length", str(len(data)).encode()))
+                    await send({**start, "headers": headers})
+                    return await send({"type": "http.response.body", "body": data})
+                await send({**start, "headers": headers})
+            data = compressor.compress(body)
+            if not more_body:
+                data += compressor.finish()
+            if data or not more_body:
+                await send({"type": "http.response.body", "body": data, "more_body": more_body})
+
+        await self.app(scope, receive, send_wrapper)
+
+
+class MetricsMiddleware:
+    """Per-route request count, latency (until the last body byte) and in-flight gauge.
+
+    `route_var`, when given, holds the route label while the request runs
+    (the log formatter reads it).
+    """
+
+    def __init__(self, app, requests: Counter, latency: Histogram, in_flight: Gauge,
+                 route_var: Optional[ContextVar] = None):
+        self.app = app
+        self.requests = requests
+        self.latency = latency
+        self.in_flight = in_flight
+        self.route_var = route_var
+        self._static_paths = None
+
+    def route_label(self, scope) -> str:
+        # Labels are route templates ("/api/admin/import/{table}"); only known
+        # routes become labels, so scanners can't blow up cardinality
+        path = scope["path"]
+        routes = scope["app"].router.routes
+        if self._static_paths is None:
+            self._static_paths = {r.path for r in routes
+                                  if getattr(r, "path", None) and not getattr(r, "param_convertors", None)}
+        if path in self._static_paths:
+            return path
+        for r in routes:
+            if getattr(r, "param_convertors", None) and r.matches(scope)[0] != Match.NONE:
+                return r.path
+        return "unmatched"
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        method = scope["method"]
+        route = self.route_label(scope)
+        status = "500"
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = str(message["status"])
+            await send(message)
+
+        route_token = self.route_var.set(route) if self.route_var is not None else None
+        self.in_flight.inc(method, route)
+        t0 = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            self.in_flight.dec(method, route)
+            self.latency.observe(time.perf_counter() - t0, method, route)
+            self.requests.inc(method, route, status)
+            if route_token is not None:
+                self.route_var.reset(route_token)
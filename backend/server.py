@@ -1,31 +1,787 @@
 import os
-from fastapi import FastAPI, APIRouter, HTTPException, Request
+import asyncio
+import base64
+import codecs
+import csv
+import hashlib
+import io
+import json
+import random
+import time
+import atexit
+from abc import ABC, abstractmethod
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from functools import lru_cache
+from fastapi import FastAPI, APIRouter, File, HTTPException, Query, Request, Response, UploadFile
+from fastapi.responses import StreamingResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
-from supabase import create_client, Client
-import httpx
 import logging
+from logging.handlers import QueueHandler, QueueListener
 from pathlib import Path
-from pydantic import BaseModel, Field, EmailStr
-from typing import List, Optional
+from queue import SimpleQueue
+from pydantic import BaseModel, Field, EmailStr, TypeAdapter, ValidationError
+from typing import TYPE_CHECKING, AsyncIterator, Dict, List, Optional, Tuple
+from collections import OrderedDict, deque
 import uuid
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
+from metrics import Registry, CONTENT_TYPE as METRICS_CONTENT_TYPE
+from middleware import (CompressionMiddleware, MemoryRateLimitStore, MetricsMiddleware, RateLimitMiddleware,
+                        RateLimitStore)
+from storage import MemoryStorage, SQLiteStorage, Storage, SupabaseStorage
+
+# httpx and postgrest are imported on first use (see init_supabase and
+# _get_openrouter_client) to keep them off the cold-start import path
+if TYPE_CHECKING:
+    import httpx
+    from postgrest import AsyncPostgrestClient
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
+# Logging: "json" (one object per line) or "text". With LOG_QUEUE_ENABLED the
+# request path only enqueues records; a listener thread formats and writes them,
+# so slow stdout never stalls the event loop
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "json").lower()
+LOG_QUEUE_ENABLED = os.environ.get("LOG_QUEUE_ENABLED", "true").lower() in ("1", "true", "yes")
+# Share of INFO/DEBUG records kept per route, e.g. "/api/leads=0.1,/api/newsletter=0.1";
+# warnings and errors are never sampled
+LOG_SAMPLE_RATES = {
+    route.strip(): float(rate)
+    for route, _, rate in (item.rpartition("=") for item in os.environ.get("LOG_SAMPLE_RATES", "").split(","))
+    if route.strip()
+}
+
+# Route template of the request being served (set by MetricsMiddleware)
+_log_route: ContextVar[Optional[str]] = ContextVar("log_route", default=None)
+
+_LOG_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "taskName"}
+
+class JsonLogFormatter(logging.Formatter):
+    """One JSON object per record; `extra=` fields become top-level keys."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _LOG_RECORD_ATTRS:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+class RouteLogSampler(logging.Filter):
+    """Tags records with the current route and drops sampled-out INFO/DEBUG ones."""
+
+    def __init__(self, rates: Dict[str, float]):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        route = _log_route.get()
+        if route is None:
+            return True
+        record.route = route
+        rate = self.rates.get(route)
+        return rate is None or record.levelno > logging.INFO or random.random() < rate
+
+class _DeferredQueueHandler(QueueHandler):
+    """Enqueues records as-is, so %-formatting also happens on the listener thread."""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+log_handler = logging.StreamHandler()
+log_handler.setFormatter(JsonLogFormatter() if LOG_FORMAT == "json" else
+                         logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+if LOG_QUEUE_ENABLED:
+    _log_queue: SimpleQueue = SimpleQueue()
+    _root_log_handler: logging.Handler = _DeferredQueueHandler(_log_queue)
+    log_listener: Optional[QueueListener] = QueueListener(_log_queue, log_handler)
+    log_listener.start()
+    atexit.register(log_listener.stop)
+else:
+    _root_log_handler = log_handler
+    log_listener = None
+_root_log_handler.addFilter(RouteLogSampler(LOG_SAMPLE_RATES))
+logging.basicConfig(level=LOG_LEVEL, handlers=[_root_log_handler])
+
+@lru_cache(maxsize=None)
+def _http2_available() -> bool:
+    """HTTP/2 needs the optional `h2` package (httpx[http2]); fall back to HTTP/1.1 keep-alive without it."""
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+# orjson is optional; the stdlib encoder is the fallback
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# Metrics (served at /metrics)
+metrics = Registry()
+HTTP_REQUESTS = metrics.counter("http_requests_total", "HTTP requests", ("method", "route", "status"))
+HTTP_LATENCY = metrics.histogram("http_request_duration_seconds",
+                                 "HTTP request latency, including streamed bodies", ("method", "route"))
+HTTP_IN_FLIGHT = metrics.gauge("http_requests_in_flight", "HTTP requests being served", ("method", "route"))
+SUPABASE_LATENCY = metrics.histogram("supabase_request_duration_seconds", "PostgREST call duration",
+                                     ("table", "method"))
+SUPABASE_ERRORS = metrics.counter("supabase_errors_total", "Failed PostgREST calls", ("table", "method"))
+OPENROUTER_TTFB = metrics.histogram("openrouter_ttfb_seconds", "Time to first streamed token per attempt", ("key",))
+OPENROUTER_STREAM_DURATION = metrics.histogram("openrouter_stream_duration_seconds", "Upstream chat stream duration")
+OPENROUTER_STREAM_BYTES = metrics.counter("openrouter_stream_bytes_total", "Bytes forwarded from OpenRouter streams")
+CHAT_STREAMS_CANCELLED = metrics.counter("chat_streams_cancelled_total",
+                                         "Upstream chat streams cancelled because every client went away")
+CHAT_TOKENS_SAVED = metrics.counter("chat_tokens_saved_total",
+                                    "Estimated completion tokens not generated thanks to cancellation")
+CHAT_CONTEXT_TRIMMED = metrics.counter("chat_context_messages_trimmed_total",
+                                       "Chat messages compacted or dropped to fit the context budget", ("action",))
+OPENROUTER_KEY_OUTCOMES = metrics.counter("openrouter_key_requests_total", "Upstream attempts per key and outcome",
+                                          ("key", "outcome"))
+OPENROUTER_HEDGES = metrics.counter("openrouter_hedges_total",
+                                    "Chat requests that started a hedge request, by which attempt won", ("winner",))
+OPENROUTER_FIRST_TOKEN = metrics.histogram("openrouter_first_token_seconds",
+                                           "Time to the first token the client sees, across all attempts", ("hedged",))
+STARTUP_SECONDS = metrics.gauge("app_startup_seconds",
+                                "Cold-start cost per phase (lifespan startup)", ("phase",))
+
 # Supabase connection
 supabase_url = os.environ.get('SUPABASE_URL', '')
 supabase_key = os.environ.get('SUPABASE_SERVICE_KEY', '')
+# Upper bound on concurrent PostgREST calls (and pooled connections) per worker
+SUPABASE_MAX_CONCURRENCY = int(os.environ.get("SUPABASE_MAX_CONCURRENCY", "20"))
+SUPABASE_TIMEOUT = float(os.environ.get("SUPABASE_TIMEOUT", "30"))
+
+SUPABASE_CONFIGURED = bool(supabase_url and supabase_key)
+
+# Created by init_supabase() when the app starts (lifespan), closed on shutdown
+supabase: Optional["AsyncPostgrestClient"] = None
+
+def init_supabase() -> Optional["AsyncPostgrestClient"]:
+    """Create the PostgREST client (once); returns None when Supabase isn't configured."""
+    global supabase
+    if supabase is not None or not SUPABASE_CONFIGURED:
+        return supabase
+    import httpx
+    from postgrest import AsyncPostgrestClient
+
+    class _PooledPostgrestClient(AsyncPostgrestClient):
+        """Async PostgREST client whose connection pool is capped at SUPABASE_MAX_CONCURRENCY."""
+
+        def create_session(self, base_url, headers, timeout, verify=True):
+            return httpx.AsyncClient(
+                base_url=base_url,
+                headers=headers,
+                timeout=timeout,
+                verify=verify,
+                follow_redirects=True,
+                http2=_http2_available(),
+                limits=httpx.Limits(
+                    max_connections=SUPABASE_MAX_CONCURRENCY,
+                    max_keepalive_connections=SUPABASE_MAX_CONCURRENCY,
+                ),
+            )
+
+    # Talk to PostgREST directly with an async client so DB round trips never block the event loop
+    supabase = _PooledPostgrestClient(
+        f"{supabase_url.rstrip('/')}/rest/v1",
+        headers={
+            "apikey": supabase_key,
+            "Authorization": f"Bearer {supabase_key}",
+            "Accept": "application/json",
+            "Content-Type": "application/json",
+        },
+        timeout=SUPABASE_TIMEOUT,
+    )
+    return supabase
+
+async def close_supabase():
+    global supabase
+    if supabase is not None:
+        await supabase.aclose()
+        supabase = None
+
+# Where leads, newsletter, order_intents and status_checks live: "supabase"
+# (PostgREST), "sqlite" (embedded file in WAL mode, for single-node deploys) or
+# "memory" (per process, lost on restart; local runs and offline benchmarks)
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "supabase").lower()
+SQLITE_PATH = os.environ.get("SQLITE_PATH", str(ROOT_DIR / "data.db"))
+# How long a statement waits on a locked database (its own thread waits, not the event loop)
+SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+
+# Recently seen signup emails per table (bounded LRU)
+KNOWN_EMAIL_CACHE_SIZE = int(os.environ.get("KNOWN_EMAIL_CACHE_SIZE", "10000"))
+
+# Rows fetched per PostgREST request when streaming list exports
+LIST_PAGE_SIZE = int(os.environ.get("LIST_PAGE_SIZE", "500"))
+
+# Rendered list responses are cached this many seconds (0 disables), bounded to LIST_CACHE_SIZE entries
+LIST_CACHE_TTL = float(os.environ.get("LIST_CACHE_TTL", "5"))
+LIST_CACHE_SIZE = int(os.environ.get("LIST_CACHE_SIZE", "256"))
+
+# Bulk CSV import (POST /api/admin/import/{table}): rows validated and upserted per batch
+IMPORT_BATCH_SIZE = int(os.environ.get("IMPORT_BATCH_SIZE", "500"))
+IMPORT_CHUNK_BYTES = 64 * 1024
+# Invalid rows echoed back in the summary (the count is always exact)
+IMPORT_MAX_REPORTED_ERRORS = 100
+
+# /api/stats aggregates are cached this many seconds per window
+STATS_CACHE_TTL = float(os.environ.get("STATS_CACHE_TTL", "30"))
+
+# Idempotency-Key support for checkout/order intents. "memory" is per worker;
+# "supabase" shares keys across workers via the idempotency_keys table
+IDEMPOTENCY_BACKEND = os.environ.get("IDEMPOTENCY_BACKEND", "memory").lower()
+IDEMPOTENCY_TTL = float(os.environ.get("IDEMPOTENCY_TTL", "86400"))
+IDEMPOTENCY_MAX_KEYS = int(os.environ.get("IDEMPOTENCY_MAX_KEYS", "10000"))
+# How long a duplicate waits for the original request before giving up with 409
+IDEMPOTENCY_WAIT = float(os.environ.get("IDEMPOTENCY_WAIT", "15"))
+
+# Write-behind batching for insert-heavy endpoints (off by default).
+# Durability: "commit" answers after the row's batch is stored, "memory" answers
+# as soon as the row is queued (faster, but queued rows are lost on a crash)
+WRITE_BEHIND_ENABLED = os.environ.get("WRITE_BEHIND_ENABLED", "false").lower() in ("1", "true", "yes")
+WRITE_BEHIND_FLUSH_MS = int(os.environ.get("WRITE_BEHIND_FLUSH_MS", "200"))
+WRITE_BEHIND_BATCH_SIZE = int(os.environ.get("WRITE_BEHIND_BATCH_SIZE", "100"))
+WRITE_BEHIND_DURABILITY = os.environ.get("WRITE_BEHIND_DURABILITY", "commit").lower()
+WRITE_BEHIND_MAX_RETRIES = int(os.environ.get("WRITE_BEHIND_MAX_RETRIES", "3"))
+
+_db_semaphore = asyncio.Semaphore(SUPABASE_MAX_CONCURRENCY)
+
+async def db_execute(query):
+    """Run a PostgREST query builder, bounded by SUPABASE_MAX_CONCURRENCY."""
+    table = query.path.lstrip("/")
+    async with _db_semaphore:
+        t0 = time.perf_counter()
+        try:
+            return await query.execute()
+        except Exception:
+            SUPABASE_ERRORS.inc(table, query.http_method)
+            raise
+        finally:
+            SUPABASE_LATENCY.observe(time.perf_counter() - t0, table, query.http_method)
+
+if STORAGE_BACKEND == "sqlite":
+    storage: Storage = SQLiteStorage(SQLITE_PATH, SQLITE_BUSY_TIMEOUT_MS)
+elif STORAGE_BACKEND == "memory":
+    storage = MemoryStorage()
+else:
+    storage = SupabaseStorage(lambda: supabase, db_execute)
+    if not SUPABASE_CONFIGURED:
+        logging.warning("SUPABASE_URL or SUPABASE_SERVICE_KEY not set. Database operations will fail.")
+
+class KnownEmailCache:
+    """Bounded LRU of email -> stored row, so repeat signups skip the database."""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._rows: "OrderedDict[str, dict]" = OrderedDict()
+
+    def get(self, email: str) -> Optional[dict]:
+        row = self._rows.get(email)
+        if row is not None:
+            self._rows.move_to_end(email)
+        return row
+
+    def add(self, email: str, row: dict):
+        self._rows[email] = row
+        self._rows.move_to_end(email)
+        while len(self._rows) > self.maxsize:
+            self._rows.popitem(last=False)
+
+class ListResponseCache:
+    """TTL + LRU cache of rendered list pages, keyed by table and query.
+
+    Entries hold the encoded body and its strong ETag, so a poll whose
+    If-None-Match still matches is answered with a 304 and no DB round trip.
+    Writes to a table drop its entries via invalidate().
+    """
+
+    def __init__(self, ttl: float, maxsize: int):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._entries: "OrderedDict[Tuple[str, tuple], Tuple[float, bytes, str, Dict[str, str]]]" = OrderedDict()
+        # Bumped on every invalidation so a fetch that raced a write is not cached
+        self._generations: Dict[str, int] = {}
+
+    def generation(self, table: str) -> int:
+        return self._generations.get(table, 0)
+
+    def get(self, table: str, key: tuple) -> Optional[Tuple[bytes, str, Dict[str, str]]]:
+        entry = self._entries.get((table, key))
+        if entry is None:
+            return None
+        if entry[0] <= time.monotonic():
+            del self._entries[(table, key)]
+            return None
+        self._entries.move_to_end((table, key))
+        return entry[1:]
+
+    def set(self, table: str, key: tuple, body: bytes, headers: Dict[str, str], generation: int) -> str:
+        etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+        if self.ttl > 0 and generation == self.generation(table):
+            self._entries[(table, key)] = (time.monotonic() + self.ttl, body, etag, headers)
+            self._entries.move_to_end((table, key))
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return etag
+
+    def invalidate(self, table: str):
+        self._generations[table] = self.generation(table) + 1
+        for cache_key in [k for k in self._entries if k[0] == table]:
+            del self._entries[cache_key]
+
+list_cache = ListResponseCache(LIST_CACHE_TTL, LIST_CACHE_SIZE)
+stats_cache = ListResponseCache(STATS_CACHE_TTL, 32)
+
+known_emails = {
+    "leads": KnownEmailCache(KNOWN_EMAIL_CACHE_SIZE),
+    "newsletter": KnownEmailCache(KNOWN_EMAIL_CACHE_SIZE),
+}
+
+async def upsert_by_email(table: str, data: dict) -> Tuple[dict, Optional[bool]]:
+    """Insert `data` unless its email is already stored; returns (row, created).
+
+    New emails take a single INSERT ... ON CONFLICT (email) DO NOTHING, which
+    also closes the select-then-insert race on concurrent submits. With
+    write-behind in "memory" durability the row is only queued, so `created`
+    is None (unconfirmed) and `row` is the submitted data.
+    """
+    email = data["email"]
+    cache = known_emails[table]
+    row = cache.get(email)
+    if row is not None:
+        return row, False
+
+    if write_behind is not None:
+        # Batched ON CONFLICT DO NOTHING; the flush resolves each row to the stored one
+        result = await write_behind.put(table, data)
+        return result if result is not None else (data, None)
+
+    inserted = await storage.insert_unique(table, [data], "email")
+    if inserted:
+        row, created = inserted[0], True
+    else:
+        existing = await storage.find(table, "email", email)
+        if existing is not None:
+            row, created = existing, False
+        else:
+            await storage.insert(table, [data])
+            row, created = data, True
+    cache.add(email, row)
+    if created:
+        list_cache.invalidate(table)
+    return row, created
+
+class WriteBehindQueue:
+    """Buffers inserts per table and flushes them as bulk inserts.
+
+    A flush runs every WRITE_BEHIND_FLUSH_MS or as soon as a table has
+    WRITE_BEHIND_BATCH_SIZE rows queued. Signup tables are flushed as
+    ON CONFLICT (email) DO NOTHING upserts, and each waiting request gets
+    (stored row, created) back: the row holding that email when it already
+    existed. Emails enter known_emails only once their flush succeeded.
+    Failed batches are retried up to WRITE_BEHIND_MAX_RETRIES times; in
+    "commit" mode the waiting requests get the error instead.
+    """
+
+    def __init__(self, flush_interval: float, batch_size: int, wait_for_commit: bool):
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.wait_for_commit = wait_for_commit
+        # table -> [row, future or None, attempts]
+        self._pending: Dict[str, list] = {}
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+        self.batches = 0
+        self.submitted = 0
+        # Rows actually stored; signup rows whose email already existed count as duplicates
+        self.rows = 0
+        self.duplicates = 0
+        self.failures = 0
+        self.dropped = 0
+        self.last_batch_size = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self.total_flush_ms = 0.0
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop the flush loop and drain everything still queued."""
+        # Let an in-progress flush finish rather than cancelling it mid-request
+        self._stopping = True
+        self._wakeup.set()
+        if self._task is not None:
+            await self._task
+        await self.flush_all(final=True)
+
+    async def put(self, table: str, row: dict) -> Optional[Tuple[dict, bool]]:
+        """Queue `row`; in "commit" mode wait for its flush and return (stored row, created)."""
+        fut = asyncio.get_running_loop().create_future() if self.wait_for_commit else None
+        queue = self._pending.setdefault(table, [])
+        queue.append([row, fut, 0])
+        if len(queue) >= self.batch_size:
+            self._wakeup.set()
+        if fut is not None:
+            return await fut
+        return None
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush_all()
+
+    async def flush_all(self, final: bool = False):
+        for table in list(self._pending):
+            queue = self._pending[table]
+            while queue:
+                batch = queue[:self.batch_size]
+                del queue[:self.batch_size]
+                if not await self._flush(table, batch) and not final:
+                    # Leave retried rows for the next tick instead of spinning on a failing DB
+                    break
+
+    async def _flush(self, table: str, batch: list) -> bool:
+        rows = [item[0] for item in batch]
+        t0 = time.monotonic()
+        try:
+            if table in known_emails:
+                inserted = await storage.insert_unique(table, rows, "email")
+            else:
+                await storage.insert(table, rows)
+                inserted = rows
+        except Exception as e:
+            self.failures += 1
+            logger.error("Write-behind flush of %s %s rows failed: %s", len(rows), table, e)
+            retry = []
+            for item in batch:
+                item[2] += 1
+                if item[1] is not None:
+                    if not item[1].done():
+                        item[1].set_exception(e)
+                elif item[2] <= WRITE_BEHIND_MAX_RETRIES:
+                    retry.append(item)
+                else:
+                    self.dropped += 1
+            self._pending.setdefault(table, [])[:0] = retry
+            return False
+
+        elapsed = (time.monotonic() - t0) * 1000
+        if inserted:
+            list_cache.invalidate(table)
+        self.batches += 1
+        self.submitted += len(rows)
+        self.rows += len(inserted)
+        self.duplicates += len(rows) - len(inserted)
+        self.last_batch_size = len(rows)
+        self.last_flush_ms = elapsed
+        self.max_flush_ms = max(self.max_flush_ms, elapsed)
+        self.total_flush_ms += elapsed
+        if table in known_emails:
+            results = await self._resolve_signups(table, rows, inserted)
+        else:
+            results = {row["id"]: (row, True) for row in rows}
+        for item in batch:
+            fut = item[1]
+            if fut is None or fut.done():
+                continue
+            result = results[item[0]["id"]]
+            if isinstance(result, Exception):
+                fut.set_exception(result)
+            else:
+                fut.set_result(result)
+        return True
+
+    async def _resolve_signups(self, table: str, rows: List[dict], inserted: List[dict]) -> Dict[str, object]:
+        """Map each flushed row's id to (stored row, created), or to the lookup error.
+
+        Rows skipped by ON CONFLICT resolve to the row holding their email:
+        one inserted by this batch, a cached one, or a lookup.
+        """
+        cache = known_emails[table]
+        inserted_ids = {row["id"] for row in inserted}
+        stored_by_email = {row["email"]: row for row in inserted}
+        results: Dict[str, object] = {}
+        for row in rows:
+            email = row["email"]
+            if row["id"] in inserted_ids:
+                results[row["id"]] = (row, True)
+                continue
+            stored = stored_by_email.get(email) or cache.get(email)
+            if stored is None:
+                try:
+                    stored = await storage.find(table, "email", email)
+                except Exception as e:
+                    logger.error("Write-behind lookup of existing %s row failed: %s", table, e)
+                    results[row["id"]] = e
+                    continue
+                # Deleted since the conflict: report the submitted data as it was
+                stored = stored or row
+                stored_by_email[email] = stored
+            results[row["id"]] = (stored, False)
+        for email, stored in stored_by_email.items():
+            cache.add(email, stored)
+        return results
+
+    def snapshot(self) -> dict:
+        return {
+            "durability": "commit" if self.wait_for_commit else "memory",
+            "flush_interval_ms": round(self.flush_interval * 1000),
+            "batch_size": self.batch_size,
+            "queued": {table: len(queue) for table, queue in self._pending.items()},
+            "batches": self.batches,
+            "submitted": self.submitted,
+            "rows": self.rows,
+            "duplicates": self.duplicates,
+            "failures": self.failures,
+            "dropped": self.dropped,
+            "avg_batch_size": round(self.submitted / self.batches, 1) if self.batches else 0,
+            "last_batch_size": self.last_batch_size,
+            "last_flush_ms": round(self.last_flush_ms, 1),
+            "avg_flush_ms": round(self.total_flush_ms / self.batches, 1) if self.batches else 0,
+            "max_flush_ms": round(self.max_flush_ms, 1),
+        }
+
+write_behind: Optional[WriteBehindQueue] = None
+
+async def insert_row(table: str, data: dict) -> bool:
+    """Insert one row, through the write-behind queue when it is enabled.
+
+    Returns False when the row was only queued (write-behind "memory"
+    durability); handlers answer those with 202 Accepted.
+    """
+    if write_behind is not None:
+        return await write_behind.put(table, data) is not None
+    await storage.insert(table, [data])
+    list_cache.invalidate(table)
+    return True
+
+class IdempotencyStore(ABC):
+    """Backend for Idempotency-Key records.
+
+    A record is claimed before the handler runs and completed with the
+    response afterwards. Claiming is what stops two workers from both
+    running the handler; implementations must make it atomic.
+    """
+
+    @abstractmethod
+    async def claim(self, key: str, fingerprint: str) -> bool:
+        """Reserve `key`; False if another request already holds or completed it."""
+
+    @abstractmethod
+    async def get(self, key: str) -> Optional[dict]:
+        """The record for `key` ({"fingerprint", "status_code", "body"}) or None.
+        status_code is None while the original request is still running."""
+
+    @abstractmethod
+    async def complete(self, key: str, status_code: int, body: bytes):
+        """Store the response for a claimed key."""
+
+    @abstractmethod
+    async def release(self, key: str):
+        """Drop a claim whose request failed so the client can retry."""
+
+class MemoryIdempotencyStore(IdempotencyStore):
+    """Bounded in-process TTL store (one per worker)."""
 
-if not supabase_url or not supabase_key:
-    logging.warning("SUPABASE_URL or SUPABASE_SERVICE_KEY not set. Database operations will fail.")
-    supabase: Optional[Client] = None
+    def __init__(self, ttl: float, maxsize: int):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._records: "OrderedDict[str, Tuple[float, dict]]" = OrderedDict()
+
+    async def claim(self, key: str, fingerprint: str) -> bool:
+        if await self.get(key) is not None:
+            return False
+        self._records[key] = (time.monotonic() + self.ttl,
+                              {"fingerprint": fingerprint, "status_code": None, "body": None})
+        while len(self._records) > self.maxsize:
+            self._records.popitem(last=False)
+        return True
+
+    async def get(self, key: str) -> Optional[dict]:
+        entry = self._records.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= time.monotonic():
+            del self._records[key]
+            return None
+        return entry[1]
+
+    async def complete(self, key: str, status_code: int, body: bytes):
+        record = await self.get(key)
+        if record is not None:
+            record["status_code"] = status_code
+            record["body"] = body
+
+    async def release(self, key: str):
+        self._records.pop(key, None)
+
+class SupabaseIdempotencyStore(IdempotencyStore):
+    """Shared store on the idempotency_keys table (see DOCS/SUPABASE_SCHEMA.md)."""
+
+    TABLE = "idempotency_keys"
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+
+    async def claim(self, key: str, fingerprint: str) -> bool:
+        row = {"key": key, "fingerprint": fingerprint,
+               "created_at": datetime.now(timezone.utc).isoformat()}
+        result = await db_execute(
+            supabase.table(self.TABLE).upsert(row, ignore_duplicates=True, on_conflict="key"))
+        if result.data:
+            return True
+        # Key exists; if it has expired, reclaim it once
+        if await self.get(key) is None:
+            result = await db_execute(
+                supabase.table(self.TABLE).upsert(row, ignore_duplicates=True, on_conflict="key"))
+            return bool(result.data)
+        return False
+
+    async def get(self, key: str) -> Optional[dict]:
+        result = await db_execute(supabase.table(self.TABLE).select('*').eq('key', key).limit(1))
+        if not result.data:
+            return None
+        row = result.data[0]
+        age = (datetime.now(timezone.utc) - datetime.fromisoformat(row["created_at"])).total_seconds()
+        if age > self.ttl:
+            await db_execute(supabase.table(self.TABLE).delete().eq('key', key))
+            return None
+        body = row.get("body")
+        return {"fingerprint": row.get("fingerprint"), "status_code": row.get("status_code"),
+                "body": body.encode() if body is not None else None}
+
+    async def complete(self, key: str, status_code: int, body: bytes):
+        await db_execute(supabase.table(self.TABLE)
+                         .update({"status_code": status_code, "body": body.decode()}).eq('key', key))
+
+    async def release(self, key: str):
+        await db_execute(supabase.table(self.TABLE).delete().eq('key', key))
+
+if IDEMPOTENCY_BACKEND == "supabase" and SUPABASE_CONFIGURED:
+    idempotency_store: IdempotencyStore = SupabaseIdempotencyStore(IDEMPOTENCY_TTL)
 else:
-    supabase: Client = create_client(supabase_url, supabase_key)
+    if IDEMPOTENCY_BACKEND == "supabase":
+        logging.warning("IDEMPOTENCY_BACKEND=supabase but Supabase is not configured; keys are kept per worker")
+    idempotency_store = MemoryIdempotencyStore(IDEMPOTENCY_TTL, IDEMPOTENCY_MAX_KEYS)
+
+# Requests running in this worker, by idempotency key, so duplicates can await them directly
+_idempotency_inflight: Dict[str, asyncio.Future] = {}
+
+def _replay(record: dict) -> Response:
+    return Response(content=record["body"], status_code=record["status_code"],
+                    media_type="application/json", headers={"Idempotent-Replayed": "true"})
+
+async def run_idempotent(request: Request, scope: str, payload: BaseModel, handler) -> Response:
+    """Run `handler` at most once per Idempotency-Key header value.
+
+    A repeated key gets the stored response; a duplicate arriving while the
+    first request is still running waits for it (up to IDEMPOTENCY_WAIT)
+    instead of inserting again. Only confirmed 2xx responses are stored, so
+    failed requests and 202s for rows merely queued can be retried.
+    """
+    raw_key = request.headers.get("idempotency-key")
+    if not raw_key:
+        return await handler()
+    if len(raw_key) > 255:
+        raise HTTPException(status_code=400, detail="Idempotency-Key too long")
+    key = f"{scope}:{raw_key}"
+    fingerprint = hashlib.sha1(payload.model_dump_json().encode()).hexdigest()
+
+    def check_fingerprint(record: dict):
+        if record.get("fingerprint") and record["fingerprint"] != fingerprint:
+            raise HTTPException(status_code=422, detail="Idempotency-Key reused with a different payload")
+
+    deadline = time.monotonic() + IDEMPOTENCY_WAIT
+    inflight = _idempotency_inflight.get(key)
+    if inflight is not None:
+        try:
+            record = await asyncio.wait_for(asyncio.shield(inflight), timeout=IDEMPOTENCY_WAIT)
+        except asyncio.TimeoutError:
+            raise HTTPException(status_code=409, detail="A request with this Idempotency-Key is still in progress")
+        if record is not None:
+            check_fingerprint(record)
+            return _replay(record)
+    while not await idempotency_store.claim(key, fingerprint):
+        record = await idempotency_store.get(key)
+        if record is not None:
+            check_fingerprint(record)
+            if record["status_code"] is not None:
+                return _replay(record)
+        if time.monotonic() >= deadline:
+            raise HTTPException(status_code=409, detail="A request with this Idempotency-Key is still in progress")
+        # Held by another worker; poll until it completes
+        await asyncio.sleep(0.1)
+
+    fut = asyncio.get_running_loop().create_future()
+    _idempotency_inflight[key] = fut
+    record = None
+    try:
+        response = await handler()
+        if 200 <= response.status_code < 300 and response.status_code != 202:
+            try:
+                await idempotency_store.complete(key, response.status_code, response.body)
+                record = {"fingerprint": fingerprint, "status_code": response.status_code, "body": response.body}
+            except Exception as e:
+                # The work is done; answer it, the key just won't replay
+                logger.warning("Idempotency store failed to complete %s: %s", key, e)
+        return response
+    finally:
+        try:
+            if record is None:
+                await idempotency_store.release(key)
+        except Exception as e:
+            logger.warning("Idempotency store failed to release %s: %s", key, e)
+        finally:
+            # Always wake same-worker duplicates, whatever the store did
+            _idempotency_inflight.pop(key, None)
+            fut.set_result(record)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global write_behind
+    t0 = time.perf_counter()
+    init_supabase()
+    await storage.open()
+    probe_task = asyncio.create_task(key_scheduler.probe_loop())
+    health_task = asyncio.create_task(dependency_probe.loop())
+    if WRITE_BEHIND_ENABLED and storage.configured:
+        write_behind = WriteBehindQueue(
+            WRITE_BEHIND_FLUSH_MS / 1000,
+            WRITE_BEHIND_BATCH_SIZE,
+            wait_for_commit=WRITE_BEHIND_DURABILITY != "memory",
+        )
+        write_behind.start()
+    STARTUP_SECONDS.set("lifespan", value=time.perf_counter() - t0)
+    yield
+    probe_task.cancel()
+    health_task.cancel()
+    if write_behind is not None:
+        await write_behind.stop()
+        write_behind = None
+    await _close_openrouter_client()
+    await storage.close()
+    await close_supabase()
 
 # Create the main app
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 # Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
@@ -41,12 +797,33 @@ ADMIN_API_KEY = os.environ.get("ADMIN_API_KEY", "")
 OPENROUTER_MODEL = os.environ.get("OPENROUTER_MODEL", "openai/gpt-3.5-turbo")
 OPENROUTER_API_KEY = os.environ.get("OPENROUTER_API_KEY", "")
 OPENROUTER_API_KEYS = [k.strip() for k in os.environ.get("OPENROUTER_API_KEYS", "").replace(";", ",").split(",") if k.strip()] or ([OPENROUTER_API_KEY] if OPENROUTER_API_KEY else [])
+OPENROUTER_CHAT_URL = "https://openrouter.ai/api/v1/chat/completions"
+OPENROUTER_TIMEOUT = float(os.environ.get("OPENROUTER_TIMEOUT", "60"))
+OPENROUTER_MAX_CONNECTIONS = int(os.environ.get("OPENROUTER_MAX_CONNECTIONS", "100"))
+OPENROUTER_KEY_CHECK_URL = "https://openrouter.ai/api/v1/auth/key"
+# Key circuit breaker: consecutive failures before a key is benched, base/max bench time, probe cadence
+OPENROUTER_CIRCUIT_FAILURES = int(os.environ.get("OPENROUTER_CIRCUIT_FAILURES", "3"))
+OPENROUTER_CIRCUIT_COOLDOWN = float(os.environ.get("OPENROUTER_CIRCUIT_COOLDOWN", "30"))
+OPENROUTER_CIRCUIT_MAX_COOLDOWN = float(os.environ.get("OPENROUTER_CIRCUIT_MAX_COOLDOWN", "600"))
+OPENROUTER_PROBE_INTERVAL = float(os.environ.get("OPENROUTER_PROBE_INTERVAL", "15"))
+# Opt-in request hedging: with no first token after OPENROUTER_HEDGE_AFTER seconds,
+# the same request also goes to the next key and the first one to answer wins
+OPENROUTER_HEDGE_ENABLED = os.environ.get("OPENROUTER_HEDGE_ENABLED", "false").lower() in ("1", "true", "yes")
+OPENROUTER_HEDGE_AFTER = float(os.environ.get("OPENROUTER_HEDGE_AFTER", "2.0"))
+# Opt-in cache of complete chat answers, keyed on the normalized conversation + model
+CHAT_CACHE_ENABLED = os.environ.get("CHAT_CACHE_ENABLED", "false").lower() in ("1", "true", "yes")
+CHAT_CACHE_TTL = float(os.environ.get("CHAT_CACHE_TTL", "3600"))
+CHAT_CACHE_SIZE = int(os.environ.get("CHAT_CACHE_SIZE", "500"))
+CHAT_CACHE_MAX_BYTES = int(os.environ.get("CHAT_CACHE_MAX_BYTES", "65536"))
+# Seconds of silence after which the chat stream gets an SSE keep-alive comment
+CHAT_HEARTBEAT_INTERVAL = float(os.environ.get("CHAT_HEARTBEAT_INTERVAL", "15"))
+# Identical chats arriving while one is streaming share that upstream generation
+CHAT_COALESCE_ENABLED = os.environ.get("CHAT_COALESCE_ENABLED", "true").lower() in ("1", "true", "yes")
+# Estimated-token budget for the conversation forwarded upstream (0 disables trimming);
+# older turns over budget are cut down to CHAT_CONTEXT_COMPACT_TOKENS, then dropped
+CHAT_CONTEXT_TOKEN_BUDGET = int(os.environ.get("CHAT_CONTEXT_TOKEN_BUDGET", "6000"))
+CHAT_CONTEXT_COMPACT_TOKENS = int(os.environ.get("CHAT_CONTEXT_COMPACT_TOKENS", "100"))
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
 logger = logging.getLogger(__name__)
 
 # Define Models
@@ -59,9 +836,12 @@ class StatusCheckCreate(BaseModel):
     client_name: str
 
 # Leads
+# Read models take email as a plain str: it was validated by the Create model
+# on the way in, and re-checking EmailStr on every listed row is the slowest
+# part of encoding a page
 class Lead(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
-    email: EmailStr
+    email: str
     source: Optional[str] = None
     created_at: datetime = Field(default_factory=datetime.utcnow)
 
@@ -101,7 +881,7 @@ class ChatCompletionRequest(BaseModel):
 # Newsletter subscribers
 class Newsletter(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
-    email: EmailStr
+    email: str
     source: Optional[str] = None
     created_at: datetime = Field(default_factory=datetime.utcnow)
 
@@ -110,179 +890,800 @@ class NewsletterCreate(BaseModel):
     source: Optional[str] = None
 
 
-# Helper function to check Supabase connection
-def check_supabase():
-    if not supabase:
+# Serialization: DB rows are validated once through a cached TypeAdapter and
+# encoded straight to bytes; handlers return a Response so FastAPI's
+# response_model does not validate and encode them a second time
+def dumps(obj) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj, default=str)
+    return json.dumps(obj, separators=(",", ":"), default=str).encode()
+
+@lru_cache(maxsize=None)
+def _rows_adapter(model) -> TypeAdapter:
+    return TypeAdapter(List[model])
+
+def encode_rows(model, rows: List[dict]) -> bytes:
+    adapter = _rows_adapter(model)
+    return adapter.dump_json(adapter.validate_python(rows))
+
+def json_response(body: bytes, status_code: int = 200) -> Response:
+    return Response(content=body, status_code=status_code, media_type="application/json")
+
+
+# Helper function to check the storage backend is usable
+def check_storage():
+    if not storage.configured:
         raise HTTPException(status_code=500, detail="Database not configured")
 
+# Helper function to protect admin endpoints (no-op when ADMIN_API_KEY is unset)
+def check_admin(request: Request):
+    if ADMIN_API_KEY and request.headers.get("x-admin-key") != ADMIN_API_KEY:
+        raise HTTPException(status_code=401, detail="unauthorized")
+
+def require_admin(request: Request):
+    """check_admin for endpoints that write: refused outright when no ADMIN_API_KEY is set."""
+    if not ADMIN_API_KEY:
+        raise HTTPException(status_code=503, detail="admin key not configured")
+    check_admin(request)
+
+
+# Keyset pagination for list endpoints: rows are ordered by (time column, id)
+# descending and the cursor is the last row's pair, so every page is an index
+# range scan no matter how deep the client pages
+def encode_cursor(row: dict, time_col: str) -> str:
+    raw = dumps([row[time_col], row["id"]])
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_cursor(cursor: Optional[str]) -> Optional[Tuple[str, str]]:
+    if not cursor:
+        return None
+    # Both values end up inside a PostgREST filter, so only accept the shapes
+    # encode_cursor produces: an ISO timestamp and a UUID
+    try:
+        ts, row_id = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        datetime.fromisoformat(ts)
+        return ts, str(uuid.UUID(row_id))
+    except Exception:
+        raise HTTPException(status_code=400, detail="invalid cursor")
+
+async def fetch_page(table: str, time_col: str, limit: int,
+                     after: Optional[Tuple[str, str]] = None) -> Tuple[List[dict], Optional[str]]:
+    """One keyset page, newest first; returns (rows, cursor for the next page or None)."""
+    rows = await storage.fetch_page(table, time_col, limit, after)
+    next_cursor = encode_cursor(rows[-1], time_col) if len(rows) == limit else None
+    return rows, next_cursor
+
+async def stream_table(table: str, time_col: str, fields: List[str], fmt: str,
+                       after: Optional[Tuple[str, str]] = None) -> StreamingResponse:
+    """Export a whole table as NDJSON or CSV, paging from storage lazily.
+
+    Only one page of LIST_PAGE_SIZE rows is held in memory at a time. The first
+    page is fetched up front so database errors still surface as a 500.
+    """
+    rows, next_cursor = await fetch_page(table, time_col, LIST_PAGE_SIZE, after)
+
+    def encode(row: dict) -> bytes:
+        if fmt == "csv":
+            buf = io.StringIO()
+            csv.writer(buf).writerow([row.get(f) for f in fields])
+            return buf.getvalue().encode()
+        return dumps({f: row.get(f) for f in fields}) + b"\n"
+
+    async def generate():
+        nonlocal rows, next_cursor
+        if fmt == "csv":
+            buf = io.StringIO()
+            csv.writer(buf).writerow(fields)
+            yield buf.getvalue()
+        while True:
+            yield b"".join(encode(row) for row in rows)
+            if next_cursor is None:
+                return
+            try:
+                rows, next_cursor = await fetch_page(table, time_col, LIST_PAGE_SIZE, decode_cursor(next_cursor))
+            except Exception as e:
+                # Headers are already sent; all we can do is end the stream early
+                logger.error("Error streaming %s: %s", table, e)
+                return
+
+    if fmt == "csv":
+        return StreamingResponse(generate(), media_type="text/csv",
+                                 headers={"Content-Disposition": f'attachment; filename="{table}.csv"'})
+    return StreamingResponse(generate(), media_type="application/x-ndjson")
+
+LIST_FORMAT_PATTERN = "^(json|ndjson|csv)$"
+
+def _etag_matches(request: Request, etag: str) -> bool:
+    # Weak comparison (RFC 9110): compression turns our ETags into W/"..."
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    return header.strip() == "*" or etag in (t.strip().removeprefix("W/") for t in header.split(","))
+
+# Public, env-derived config responses: browsers and CDNs may reuse them this long
+CONFIG_CACHE_MAX_AGE = int(os.environ.get("CONFIG_CACHE_MAX_AGE", "300"))
+
+class StaticJSON:
+    """A JSON body encoded once at startup, served with a strong ETag and public caching."""
+
+    def __init__(self, payload):
+        self.body = dumps(payload)
+        self.etag = '"' + hashlib.sha1(self.body).hexdigest() + '"'
+        self.headers = {"ETag": self.etag, "Cache-Control": f"public, max-age={CONFIG_CACHE_MAX_AGE}"}
+
+    def response(self, request: Request) -> Response:
+        if _etag_matches(request, self.etag):
+            return Response(status_code=304, headers=self.headers)
+        return Response(content=self.body, media_type="application/json", headers=self.headers)
+
+async def list_table(request: Request, table: str, time_col: str, model, label: str,
+                     limit: int, cursor: Optional[str], fmt: str) -> Response:
+    """Shared body of the admin list endpoints (JSON pages are cached, exports stream)."""
+    after = decode_cursor(cursor)
+    try:
+        if fmt != "json":
+            return await stream_table(table, time_col, list(model.model_fields), fmt, after)
+
+        key = (limit, cursor)
+        cached = list_cache.get(table, key)
+        if cached is not None:
+            body, etag, headers = cached
+        else:
+            generation = list_cache.generation(table)
+            rows, next_cursor = await fetch_page(table, time_col, limit, after)
+            body = encode_rows(model, rows)
+            headers = {"X-Next-Cursor": next_cursor} if next_cursor else {}
+            etag = list_cache.set(table, key, body, headers, generation)
+    except Exception as e:
+        logger.error("Error fetching %s: %s", label, e)
+        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+
+    headers = {**headers, "ETag": etag, "Cache-Control": "private, no-cache"}
+    if _etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
 
 # Routes
+ROOT_RESPONSE = StaticJSON({"message": "Hello World", "database": storage.label})
+
 @api_router.get("/")
-async def root():
-    return {"message": "Hello World", "database": "Supabase PostgreSQL"}
+async def root(request: Request):
+    return ROOT_RESPONSE.response(request)
 
 @api_router.post("/status", response_model=StatusCheck)
 async def create_status_check(input: StatusCheckCreate):
-    check_supabase()
-    status_obj = StatusCheck(**input.dict())
-    data = status_obj.dict()
-    data['timestamp'] = data['timestamp'].isoformat()
+    check_storage()
+    data = StatusCheck(**input.model_dump()).model_dump(mode="json")
     
     try:
-        supabase.table('status_checks').insert(data).execute()
-        return status_obj
+        committed = await insert_row('status_checks', data)
+        return json_response(dumps(data), status_code=200 if committed else 202)
     except Exception as e:
-        logger.error(f"Error creating status check: {str(e)}")
+        logger.error("Error creating status check: %s", e)
         raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
 
 @api_router.get("/status", response_model=List[StatusCheck])
-async def get_status_checks():
-    check_supabase()
-    try:
-        result = supabase.table('status_checks').select('*').limit(1000).execute()
-        return [StatusCheck(**item) for item in result.data]
-    except Exception as e:
-        logger.error(f"Error fetching status checks: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+async def get_status_checks(request: Request,
+                            limit: int = Query(1000, ge=1, le=1000),
+                            cursor: Optional[str] = None,
+                            fmt: str = Query("json", alias="format", pattern=LIST_FORMAT_PATTERN)):
+    check_storage()
+    return await list_table(request, 'status_checks', 'timestamp', StatusCheck, "status checks", limit, cursor, fmt)
 
 # Leads endpoints
 @api_router.post("/leads", response_model=Lead, status_code=201)
 async def create_lead(input: LeadCreate):
-    check_supabase()
-    lead = Lead(**input.dict())
+    check_storage()
+    data = Lead(**input.model_dump()).model_dump(mode="json")
     
     try:
-        # Check if email already exists
-        existing = supabase.table('leads').select('*').eq('email', lead.email).execute()
-        if existing.data:
-            logger.info(f"Lead already exists: {lead.email}")
-            return Lead(**existing.data[0])
-        
-        # Insert new lead
-        data = lead.dict()
-        data['created_at'] = data['created_at'].isoformat()
-        supabase.table('leads').insert(data).execute()
-        logger.info(f"New lead created: {lead.email}")
-        return lead
+        row, created = await upsert_by_email('leads', data)
+        if created:
+            logger.info("New lead created: %s", data['email'])
+            return json_response(dumps(data), status_code=201)
+        if created is None:
+            # Write-behind "memory" durability: queued, not yet stored
+            logger.info("Lead queued: %s", data['email'])
+            return json_response(dumps(data), status_code=202)
+        logger.info("Lead already exists: %s", data['email'])
+        return json_response(Lead(**row).model_dump_json().encode(), status_code=201)
     except Exception as e:
-        logger.error(f"Error creating lead: {str(e)}")
+        logger.error("Error creating lead: %s", e)
         raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
 
 @api_router.get("/leads", response_model=List[Lead])
-async def list_leads(request: Request):
-    check_supabase()
-    if ADMIN_API_KEY and request.headers.get("x-admin-key") != ADMIN_API_KEY:
-        raise HTTPException(status_code=401, detail="unauthorized")
-    
-    try:
-        result = supabase.table('leads').select('*').order('created_at', desc=True).limit(1000).execute()
-        return [Lead(**item) for item in result.data]
-    except Exception as e:
-        logger.error(f"Error fetching leads: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+async def list_leads(request: Request,
+                     limit: int = Query(1000, ge=1, le=1000),
+                     cursor: Optional[str] = None,
+                     fmt: str = Query("json", alias="format", pattern=LIST_FORMAT_PATTERN)):
+    check_storage()
+    check_admin(request)
+    return await list_table(request, 'leads', 'created_at', Lead, "leads", limit, cursor, fmt)
 
 # Order intents endpoints
 @api_router.post("/orders-intent", response_model=OrderIntent, status_code=201)
-async def create_order_intent(input: OrderIntentCreate):
-    check_supabase()
-    oi = OrderIntent(**input.dict())
-    
-    try:
-        data = oi.dict()
-        data['created_at'] = data['created_at'].isoformat()
-        supabase.table('order_intents').insert(data).execute()
-        logger.info(f"Order intent created: {oi.id}")
-        return oi
-    except Exception as e:
-        logger.error(f"Error creating order intent: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+async def create_order_intent(input: OrderIntentCreate, request: Request):
+    check_storage()
+
+    async def handle() -> Response:
+        data = OrderIntent(**input.model_dump()).model_dump(mode="json")
+        try:
+            if not await insert_row('order_intents', data):
+                logger.info("Order intent queued: %s", data['id'])
+                return json_response(dumps(data), status_code=202)
+            logger.info("Order intent created: %s", data['id'])
+            return json_response(dumps(data), status_code=201)
+        except Exception as e:
+            logger.error("Error creating order intent: %s", e)
+            raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+
+    return await run_idempotent(request, "orders-intent", input, handle)
 
 @api_router.get("/orders-intent", response_model=List[OrderIntent])
-async def list_order_intents(request: Request):
-    check_supabase()
-    if ADMIN_API_KEY and request.headers.get("x-admin-key") != ADMIN_API_KEY:
-        raise HTTPException(status_code=401, detail="unauthorized")
-    
-    try:
-        result = supabase.table('order_intents').select('*').order('created_at', desc=True).limit(1000).execute()
-        return [OrderIntent(**item) for item in result.data]
-    except Exception as e:
-        logger.error(f"Error fetching order intents: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+async def list_order_intents(request: Request,
+                             limit: int = Query(1000, ge=1, le=1000),
+                             cursor: Optional[str] = None,
+                             fmt: str = Query("json", alias="format", pattern=LIST_FORMAT_PATTERN)):
+    check_storage()
+    check_admin(request)
+    return await list_table(request, 'order_intents', 'created_at', OrderIntent, "order intents", limit, cursor, fmt)
 
 # Checkout integration scaffold
+CHECKOUT_CONFIG_RESPONSE = StaticJSON({
+    "provider": CHECKOUT_PROVIDER,
+    "public_url": CHECKOUT_PUBLIC_URL,
+})
+
 @api_router.get("/checkout/config")
-async def checkout_config():
-    return {
-        "provider": CHECKOUT_PROVIDER,
-        "public_url": CHECKOUT_PUBLIC_URL,
-    }
+async def checkout_config(request: Request):
+    return CHECKOUT_CONFIG_RESPONSE.response(request)
 
 @api_router.post("/checkout/start")
-async def checkout_start(payload: CheckoutStart):
-    check_supabase()
-    # Persist an intent
-    oi = OrderIntent(price=payload.price, currency=payload.currency, note=payload.note, email=payload.email)
-    
-    try:
-        data = oi.dict()
-        data['created_at'] = data['created_at'].isoformat()
-        supabase.table('order_intents').insert(data).execute()
-        logger.info(f"Checkout started: {oi.id}")
-    except Exception as e:
-        logger.error(f"Error in checkout start: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+async def checkout_start(payload: CheckoutStart, request: Request):
+    check_storage()
 
-    # Return redirect URL based on env
-    if CHECKOUT_PUBLIC_URL:
-        sep = "&" if "?" in CHECKOUT_PUBLIC_URL else "?"
-        url = f"{CHECKOUT_PUBLIC_URL}{sep}email={payload.email or ''}"
-        return {"redirect_url": url, "order_intent_id": oi.id}
-    
-    return {"redirect_url": None, "order_intent_id": oi.id}
+    async def handle() -> Response:
+        # Persist an intent
+        oi = OrderIntent(price=payload.price, currency=payload.currency, note=payload.note, email=payload.email)
+
+        try:
+            data = oi.model_dump(mode="json")
+            committed = await insert_row('order_intents', data)
+            logger.info("Checkout started: %s", oi.id)
+        except Exception as e:
+            logger.error("Error in checkout start: %s", e)
+            raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+
+        # Return redirect URL based on env
+        url = None
+        if CHECKOUT_PUBLIC_URL:
+            sep = "&" if "?" in CHECKOUT_PUBLIC_URL else "?"
+            url = f"{CHECKOUT_PUBLIC_URL}{sep}email={payload.email or ''}"
+        return json_response(dumps({"redirect_url": url, "order_intent_id": oi.id}),
+                             status_code=200 if committed else 202)
+
+    return await run_idempotent(request, "checkout", payload, handle)
 
 # Newsletter endpoints
 @api_router.post("/newsletter", response_model=Newsletter, status_code=201)
 async def subscribe_newsletter(input: NewsletterCreate):
-    check_supabase()
-    sub = Newsletter(**input.dict())
+    check_storage()
+    data = Newsletter(**input.model_dump()).model_dump(mode="json")
     
     try:
-        # Check if email already exists
-        existing = supabase.table('newsletter').select('*').eq('email', sub.email).execute()
-        if existing.data:
-            logger.info(f"Newsletter subscription already exists: {sub.email}")
-            return Newsletter(**existing.data[0])
-        
-        # Insert new subscription
-        data = sub.dict()
-        data['created_at'] = data['created_at'].isoformat()
-        supabase.table('newsletter').insert(data).execute()
-        logger.info(f"Newsletter subscription created: {sub.email}")
-        return sub
+        row, created = await upsert_by_email('newsletter', data)
+        if created:
+            logger.info("Newsletter subscription created: %s", data['email'])
+            return json_response(dumps(data), status_code=201)
+        if created is None:
+            # Write-behind "memory" durability: queued, not yet stored
+            logger.info("Newsletter subscription queued: %s", data['email'])
+            return json_response(dumps(data), status_code=202)
+        logger.info("Newsletter subscription already exists: %s", data['email'])
+        return json_response(Newsletter(**row).model_dump_json().encode(), status_code=201)
     except Exception as e:
-        logger.error(f"Error creating newsletter subscription: {str(e)}")
+        logger.error("Error creating newsletter subscription: %s", e)
         raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
 
 @api_router.get("/newsletter", response_model=List[Newsletter])
-async def list_newsletter(request: Request):
-    check_supabase()
-    if ADMIN_API_KEY and request.headers.get("x-admin-key") != ADMIN_API_KEY:
-        raise HTTPException(status_code=401, detail="unauthorized")
-    
-    try:
-        result = supabase.table('newsletter').select('*').order('created_at', desc=True).limit(1000).execute()
-        return [Newsletter(**item) for item in result.data]
-    except Exception as e:
-        logger.error(f"Error fetching newsletter subscriptions: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+async def list_newsletter(request: Request,
+                          limit: int = Query(1000, ge=1, le=1000),
+                          cursor: Optional[str] = None,
+                          fmt: str = Query("json", alias="format", pattern=LIST_FORMAT_PATTERN)):
+    check_storage()
+    check_admin(request)
+    return await list_table(request, 'newsletter', 'created_at', Newsletter, "newsletter subscriptions",
+                            limit, cursor, fmt)
+
+# Aggregates for the dashboard (replaces downloading list pages to count in the browser)
+@api_router.get("/stats")
+async def get_stats(request: Request, days: int = Query(30, ge=1, le=366)):
+    check_storage()
+    check_admin(request)
+    cached = stats_cache.get("stats", (days,))
+    if cached is not None:
+        body, etag, _ = cached
+    else:
+        since = (datetime.now(timezone.utc).date() - timedelta(days=days - 1)).isoformat()
+        try:
+            stats = await storage.stats(since)
+        except Exception as e:
+            logger.error("Error computing stats: %s", e)
+            raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+        body = dumps({**stats, "since": since, "generated_at": datetime.now(timezone.utc).isoformat()})
+        etag = stats_cache.set("stats", (days,), body, {}, stats_cache.generation("stats"))
+
+    headers = {"ETag": etag, "Cache-Control": f"private, max-age={int(STATS_CACHE_TTL)}"}
+    if _etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
 
 # Backend LLM proxy (AI Chat - unchanged)
-from fastapi.responses import StreamingResponse
+
+# Shared upstream client: one connection pool for the whole process, so chat
+# messages reuse warm TLS connections instead of handshaking per request
+_openrouter_client: Optional["httpx.AsyncClient"] = None
+
+def _get_openrouter_client() -> "httpx.AsyncClient":
+    global _openrouter_client
+    if _openrouter_client is None or _openrouter_client.is_closed:
+        import httpx
+        _openrouter_client = httpx.AsyncClient(
+            http2=_http2_available(),
+            timeout=httpx.Timeout(OPENROUTER_TIMEOUT, connect=10.0),
+            limits=httpx.Limits(
+                max_connections=OPENROUTER_MAX_CONNECTIONS,
+                max_keepalive_connections=OPENROUTER_MAX_CONNECTIONS,
+                keepalive_expiry=60.0,
+            ),
+        )
+    return _openrouter_client
+
+async def _close_openrouter_client():
+    global _openrouter_client
+    if _openrouter_client is not None:
+        await _openrouter_client.aclose()
+        _openrouter_client = None
+
+def _parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Retry-After is either delta-seconds or an HTTP date; returns seconds from now."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+class _KeyHealth:
+    """Rolling health stats for a single OpenRouter key."""
+
+    # Smoothing factor for the error-rate and TTFB moving averages
+    ALPHA = 0.3
+
+    def __init__(self, index: int, key: str):
+        self.index = index
+        self.key = key
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.error_rate = 0.0
+        self.ttfb: Optional[float] = None
+        self.open_until = 0.0
+        self.trips = 0
+        self.last_status: Optional[int] = None
+        self.last_error: Optional[str] = None
+
+    def is_open(self, now: float) -> bool:
+        return self.open_until > now
+
+    def score(self) -> float:
+        # Lower is better: error rate dominates, TTFB breaks ties between healthy keys
+        return self.error_rate * 100.0 + (self.ttfb if self.ttfb is not None else 1.0)
+
+class OpenRouterKeyScheduler:
+    """Orders OPENROUTER_API_KEYS by health and benches failing keys.
+
+    Keys that hit OPENROUTER_CIRCUIT_FAILURES consecutive failures, or that are
+    rejected outright (401/402/403/429), get their circuit opened for the
+    Retry-After period or an exponential cooldown. A background probe checks
+    benched keys once their cooldown ends so real chats never pay for it.
+    """
+
+    def __init__(self, keys: List[str]):
+        self.keys = [_KeyHealth(i, k) for i, k in enumerate(keys)]
+        self._by_key = {h.key: h for h in self.keys}
+
+    def ordered_keys(self) -> List[str]:
+        now = time.monotonic()
+        healthy = sorted((h for h in self.keys if not h.is_open(now)), key=lambda h: h.score())
+        if healthy:
+            return [h.key for h in healthy]
+        # Every circuit is open: still try them, soonest-to-recover first, rather than fail the chat
+        return [h.key for h in sorted(self.keys, key=lambda h: h.open_until)]
+
+    def record_success(self, key: str, ttfb: float):
+        h = self._by_key.get(key)
+        if h is None:
+            return
+        OPENROUTER_KEY_OUTCOMES.inc(str(h.index), "success")
+        OPENROUTER_TTFB.observe(ttfb, str(h.index))
+        h.requests += 1
+        h.consecutive_failures = 0
+        h.error_rate *= 1 - _KeyHealth.ALPHA
+        h.ttfb = ttfb if h.ttfb is None else h.ttfb + _KeyHealth.ALPHA * (ttfb - h.ttfb)
+        h.open_until = 0.0
+        h.trips = 0
+        h.last_status = 200
+
+    def record_slow(self, key: str, waited: float):
+        """A hedge race was lost: the key's TTFB was at least `waited`."""
+        h = self._by_key.get(key)
+        if h is None:
+            return
+        OPENROUTER_KEY_OUTCOMES.inc(str(h.index), "hedge_lost")
+        h.ttfb = waited if h.ttfb is None else h.ttfb + _KeyHealth.ALPHA * (max(waited, h.ttfb) - h.ttfb)
+
+    def record_failure(self, key: str, status: Optional[int] = None,
+                       retry_after: Optional[float] = None, error: Optional[str] = None):
+        h = self._by_key.get(key)
+        if h is None:
+            return
+        OPENROUTER_KEY_OUTCOMES.inc(str(h.index), f"http_{status}" if status else "error")
+        h.requests += 1
+        h.failures += 1
+        h.consecutive_failures += 1
+        h.error_rate += _KeyHealth.ALPHA * (1 - h.error_rate)
+        h.last_status = status
+        h.last_error = error
+        if retry_after is not None or status in (401, 402, 403, 429) \
+                or h.consecutive_failures >= OPENROUTER_CIRCUIT_FAILURES:
+            self._trip(h, retry_after)
+
+    def _trip(self, h: _KeyHealth, retry_after: Optional[float]):
+        cooldown = retry_after if retry_after is not None else min(
+            OPENROUTER_CIRCUIT_COOLDOWN * (2 ** h.trips), OPENROUTER_CIRCUIT_MAX_COOLDOWN)
+        h.trips += 1
+        h.open_until = time.monotonic() + cooldown
+        logger.warning("OpenRouter key #%s benched for %.0fs (status=%s)", h.index, cooldown, h.last_status)
+
+    async def probe(self, h: _KeyHealth):
+        """Cheap auth check against a benched key; closes the circuit if it answers."""
+        try:
+            r = await _get_openrouter_client().get(
+                OPENROUTER_KEY_CHECK_URL,
+                headers={"Authorization": f"Bearer {h.key}"},
+                timeout=10.0,
+            )
+        except Exception as e:
+            self._trip(h, None)
+            h.last_error = str(e)
+            return
+        h.last_status = r.status_code
+        if r.is_success:
+            h.open_until = 0.0
+            h.trips = 0
+            h.consecutive_failures = 0
+            logger.info("OpenRouter key #%s recovered", h.index)
+        else:
+            self._trip(h, _parse_retry_after(r.headers.get("retry-after")))
+
+    async def probe_loop(self):
+        while True:
+            await asyncio.sleep(OPENROUTER_PROBE_INTERVAL)
+            now = time.monotonic()
+            for h in self.keys:
+                # Only keys whose cooldown has elapsed but have not carried traffic since
+                if h.trips and not h.is_open(now):
+                    await self.probe(h)
+
+    def snapshot(self) -> List[dict]:
+        now = time.monotonic()
+        return [
+            {
+                "index": h.index,
+                "key": f"{h.key[:10]}...{h.key[-4:]}" if len(h.key) > 14 else "***",
+                "state": "open" if h.is_open(now) else ("half-open" if h.trips else "closed"),
+                "retry_in": round(h.open_until - now, 1) if h.is_open(now) else 0,
+                "requests": h.requests,
+                "failures": h.failures,
+                "consecutive_failures": h.consecutive_failures,
+                "error_rate": round(h.error_rate, 3),
+                "ttfb_ms": round(h.ttfb * 1000) if h.ttfb is not None else None,
+                "trips": h.trips,
+                "last_status": h.last_status,
+                "last_error": h.last_error,
+            }
+            for h in self.keys
+        ]
+
+key_scheduler = OpenRouterKeyScheduler(OPENROUTER_API_KEYS)
+
+SSE_DONE_FRAME = b"data: {\"done\": true}\n\n"
+SSE_HEARTBEAT_FRAME = b": keep-alive\n\n"
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+def _last_frame_end(buf: bytes) -> int:
+    """Index just past the last complete SSE event in `buf` (0 if none)."""
+    lf, crlf = buf.rfind(b"\n\n"), buf.rfind(b"\r\n\r\n")
+    return max(lf + 2 if lf != -1 else 0, crlf + 4 if crlf != -1 else 0)
+
+# Rough chars-per-token for BPE tokenizers on Portuguese/English text, plus the
+# per-message framing (role, separators) chat templates add
+CHARS_PER_TOKEN = 4
+MESSAGE_TOKEN_OVERHEAD = 4
+
+def estimate_tokens(text: str) -> int:
+    """Cheap token estimate (no tokenizer); errs slightly high on long words."""
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+def trim_context(messages: List[dict], budget: int, compact_tokens: int) -> List[dict]:
+    """Fit `messages` into `budget` estimated tokens, preferring recent turns.
+
+    Leading system messages and the latest message are always kept. Older
+    turns are taken newest first while they fit; a turn that does not fit is
+    cut down to its first `compact_tokens`, and once even that does not fit
+    everything older is dropped.
+    """
+    if budget <= 0:
+        return messages
+    cost = [estimate_tokens(m["content"]) + MESSAGE_TOKEN_OVERHEAD for m in messages]
+    if sum(cost) <= budget:
+        return messages
+
+    head = 0
+    while head < len(messages) - 1 and messages[head]["role"] == "system":
+        head += 1
+    remaining = budget - sum(cost[:head]) - cost[-1]
+    kept: List[dict] = [messages[-1]]
+    compact_chars = compact_tokens * CHARS_PER_TOKEN
+    for i in range(len(messages) - 2, head - 1, -1):
+        if cost[i] <= remaining:
+            kept.append(messages[i])
+            remaining -= cost[i]
+            continue
+        content = messages[i]["content"][:compact_chars].rstrip() + " [...]"
+        # Charge what is actually kept, marker included
+        compact_cost = estimate_tokens(content) + MESSAGE_TOKEN_OVERHEAD
+        if compact_tokens <= 0 or compact_cost > remaining:
+            CHAT_CONTEXT_TRIMMED.inc("dropped", amount=i - head + 1)
+            break
+        kept.append({**messages[i], "content": content})
+        remaining -= compact_cost
+        CHAT_CONTEXT_TRIMMED.inc("compacted")
+    kept.reverse()
+    return messages[:head] + kept
+
+def chat_cache_key(messages: List[dict]) -> str:
+    """Hash of the model plus messages with case and whitespace normalized."""
+    normalized = [[m["role"].lower(), " ".join(m["content"].split()).lower()] for m in messages]
+    return hashlib.sha256(dumps([OPENROUTER_MODEL, normalized])).hexdigest()
+
+class ChatCompletionCache:
+    """TTL + LRU cache of finished SSE streams for /api/chat/complete."""
+
+    def __init__(self, ttl: float, maxsize: int, max_bytes: int):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[str, Tuple[float, bytes]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[bytes]:
+        entry = self._entries.get(key)
+        if entry is None or entry[0] <= time.monotonic():
+            self._entries.pop(key, None)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key: str, stream: bytes):
+        if len(stream) > self.max_bytes:
+            return
+        self._entries[key] = (time.monotonic() + self.ttl, stream)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def snapshot(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.maxsize,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0,
+        }
+
+chat_cache = ChatCompletionCache(CHAT_CACHE_TTL, CHAT_CACHE_SIZE, CHAT_CACHE_MAX_BYTES) if CHAT_CACHE_ENABLED else None
+
+# Moving average of SSE data events (~tokens) in completed answers, used to
+# estimate how much generation a cancelled stream saved
+_avg_answer_events = 0.0
+
+class HedgeStats:
+    """Counters behind the "hedging" block of GET /api/admin/openrouter/keys."""
+
+    def __init__(self):
+        self.requests = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        # winner -> [count, total seconds to first token]
+        self._first_token: Dict[str, List[float]] = {}
+
+    def record(self, hedged: bool, winner: str, first_token: float):
+        self.requests += 1
+        OPENROUTER_FIRST_TOKEN.observe(first_token, "true" if hedged else "false")
+        if hedged:
+            self.hedged += 1
+            self.hedge_wins += winner == "hedge"
+            OPENROUTER_HEDGES.inc(winner)
+        bucket = self._first_token.setdefault(winner if hedged else "unhedged", [0, 0.0])
+        bucket[0] += 1
+        bucket[1] += first_token
+
+    def snapshot(self) -> dict:
+        return {
+            "enabled": OPENROUTER_HEDGE_ENABLED,
+            "after_ms": round(OPENROUTER_HEDGE_AFTER * 1000),
+            "requests": self.requests,
+            "hedged": self.hedged,
+            "hedge_rate": round(self.hedged / self.requests, 3) if self.requests else 0,
+            "hedge_wins": self.hedge_wins,
+            "hedge_win_rate": round(self.hedge_wins / self.hedged, 3) if self.hedged else 0,
+            # Mean time to first token for unhedged requests and, among hedged
+            # ones, by which attempt answered first
+            "first_token_ms": {
+                name: round(total / count * 1000) for name, (count, total) in self._first_token.items()
+            },
+        }
+
+hedge_stats = HedgeStats()
+
+class _UpstreamAttempt:
+    """One streamed chat completion on a single key.
+
+    `frames` yields whole SSE events. Comment frames sent before the first
+    token are held back, so the first yield is the first token (which is what
+    a hedge race waits for); the generator ends without yielding when the key
+    rejects the request or fails before answering.
+    """
+
+    def __init__(self, api_key: str, headers: dict, payload: dict):
+        self.api_key = api_key
+        self.started = False
+        self.events = 0
+        self.t0 = time.monotonic()
+        self.frames = self._stream(headers, payload)
+
+    async def _stream(self, headers: dict, payload: dict):
+        global _avg_answer_events
+        client_http = _get_openrouter_client()
+        try:
+            # Single upstream request per key: fallback is decided from the
+            # status and content-type before any bytes reach the browser
+            upstream = client_http.build_request(
+                "POST",
+                OPENROUTER_CHAT_URL,
+                headers={**headers, "Authorization": f"Bearer {self.api_key}"},
+                json=payload,
+            )
+            resp = await client_http.send(upstream, stream=True)
+            try:
+                if not resp.is_success or "event-stream" not in resp.headers.get("content-type", ""):
+                    logger.warning("OpenRouter key rejected request: HTTP %s", resp.status_code)
+                    key_scheduler.record_failure(
+                        self.api_key,
+                        status=resp.status_code,
+                        retry_after=_parse_retry_after(resp.headers.get("retry-after")),
+                    )
+                    return
+                # Forward upstream bytes as whole SSE events (the browser parses
+                # per read, so an event must never be split across chunks)
+                streamed = 0
+                pending = b""
+                held = b""
+                try:
+                    async for data in resp.aiter_bytes():
+                        pending = pending + data if pending else data
+                        cut = _last_frame_end(pending)
+                        if not cut:
+                            continue
+                        frames, pending = pending[:cut], pending[cut:]
+                        done_at = frames.find(b"[DONE]")
+                        if done_at != -1:
+                            frames = frames[:frames.rfind(b"\n", 0, done_at) + 1]
+                        if not self.started:
+                            if b"data:" not in frames and done_at == -1:
+                                held += frames
+                                continue
+                            if b"data:" in frames:
+                                self.started = True
+                                key_scheduler.record_success(self.api_key, time.monotonic() - self.t0)
+                            frames, held = held + frames, b""
+                        if frames:
+                            streamed += len(frames)
+                            self.events += frames.count(b"data:")
+                            yield frames
+                        if done_at != -1:
+                            if _avg_answer_events:
+                                _avg_answer_events += 0.1 * (self.events - _avg_answer_events)
+                            else:
+                                _avg_answer_events = float(self.events)
+                            yield SSE_DONE_FRAME
+                            pending = b""
+                            break
+                    if pending:
+                        yield pending
+                finally:
+                    OPENROUTER_STREAM_BYTES.inc(amount=streamed)
+                    if self.started:
+                        OPENROUTER_STREAM_DURATION.observe(time.monotonic() - self.t0)
+            finally:
+                # Closing the response is what stops the upstream generation
+                await resp.aclose()
+        except Exception as e:
+            logger.warning("OpenRouter attempt failed: %s", e)
+            key_scheduler.record_failure(self.api_key, error=str(e))
+
+async def _first_token(keys: deque, headers: dict, payload: dict) -> Tuple[Optional[_UpstreamAttempt], bytes]:
+    """Run attempts over `keys` until one produces a token; returns it with its first frames.
+
+    Keys are tried one after another on failure. With hedging on, a second
+    attempt on the next key starts when the first is still silent after
+    OPENROUTER_HEDGE_AFTER; whichever answers first wins and the other is
+    cancelled, which closes its upstream response.
+    """
+    racing: Dict[asyncio.Future, _UpstreamAttempt] = {}
+    t0 = time.monotonic()
+    hedge: Optional[_UpstreamAttempt] = None
+
+    def launch() -> _UpstreamAttempt:
+        attempt = _UpstreamAttempt(keys.popleft(), headers, payload)
+        racing[asyncio.ensure_future(attempt.frames.__anext__())] = attempt
+        return attempt
+
+    try:
+        launch()
+        while racing:
+            can_hedge = OPENROUTER_HEDGE_ENABLED and hedge is None and keys and len(racing) == 1
+            done, _ = await asyncio.wait(racing, timeout=OPENROUTER_HEDGE_AFTER if can_hedge else None,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                logger.info("No first token after %.1fs, hedging on another key", OPENROUTER_HEDGE_AFTER)
+                hedge = launch()
+                continue
+            for future in done:
+                attempt = racing.pop(future)
+                try:
+                    first = future.result()
+                except StopAsyncIteration:
+                    continue
+                now = time.monotonic()
+                for loser in racing.values():
+                    key_scheduler.record_slow(loser.api_key, now - loser.t0)
+                hedge_stats.record(hedge is not None, "hedge" if attempt is hedge else "primary", now - t0)
+                return attempt, first
+            if not racing and keys:
+                launch()
+        return None, b""
+    finally:
+        for future, attempt in racing.items():
+            if future.done():
+                if future.exception() is None:
+                    asyncio.ensure_future(attempt.frames.aclose())
+            else:
+                future.cancel()
 
 async def _iter_openrouter_stream(messages: List[dict]):
-    api_keys = OPENROUTER_API_KEYS
-    if not api_keys:
+    if not OPENROUTER_API_KEYS:
         # No keys configured; yield nothing so client can fallback
         return
     headers = {
@@ -291,48 +1692,501 @@ async def _iter_openrouter_stream(messages: List[dict]):
         "HTTP-Referer": "https://silviosuperandolimites.com.br",
         "X-Title": "Superando Limites Chat",
     }
-    for api_key in api_keys:
+    payload = {"model": OPENROUTER_MODEL, "messages": messages, "stream": True}
+    attempt = None
+    try:
+        # Once an attempt has streamed part of the answer there is no fallback:
+        # retrying on another key would duplicate it
+        attempt, first = await _first_token(deque(key_scheduler.ordered_keys()), headers, payload)
+        if attempt is None:
+            return
+        yield first
+        async for frames in attempt.frames:
+            yield frames
+    except (asyncio.CancelledError, GeneratorExit):
+        # The consumer went away (browser disconnected) mid-attempt
+        CHAT_STREAMS_CANCELLED.inc()
+        CHAT_TOKENS_SAVED.inc(amount=max(0.0, _avg_answer_events - (attempt.events if attempt else 0)))
+        raise
+    finally:
+        if attempt is not None:
+            await attempt.frames.aclose()
+
+def _remember_answer(cache_key: Optional[str], chunks: List[bytes]):
+    # Only answers that ran to [DONE] are worth replaying
+    if chat_cache is not None and cache_key is not None and chunks and chunks[-1] == SSE_DONE_FRAME:
+        chat_cache.set(cache_key, b"".join(chunks))
+
+async def with_heartbeat(source, request: Optional[Request] = None):
+    """Relay `source`, emitting an SSE comment after CHAT_HEARTBEAT_INTERVAL of silence.
+
+    The source is drained by its own task into a queue, so waiting with a
+    timeout never cancels the source generator mid-step. When the client
+    disconnects (Starlette cancels the response, or the heartbeat tick sees
+    the disconnect) the pump task is cancelled, which closes the upstream
+    stream instead of letting the model finish.
+    """
+    queue: asyncio.Queue = asyncio.Queue()
+    end = object()
+
+    async def pump():
         try:
-            async with httpx.AsyncClient(timeout=60.0) as client_http:
-                r = await client_http.post(
-                    "https://openrouter.ai/api/v1/chat/completions",
-                    headers={**headers, "Authorization": f"Bearer {api_key}"},
-                    json={"model": OPENROUTER_MODEL, "messages": messages, "stream": True},
-                )
-                if not r.is_success or r.headers.get("content-type", "").find("event-stream") == -1:
-                    continue
-                async with client_http.stream("POST", "https://openrouter.ai/api/v1/chat/completions",
-                                              headers={**headers, "Authorization": f"Bearer {api_key}"},
-                                              json={"model": OPENROUTER_MODEL, "messages": messages, "stream": True}) as resp:
-                    async for line in resp.aiter_lines():
-                        if not line or not line.startswith("data:"):
-                            continue
-                        if "[DONE]" in line:
-                            yield "data: {\"done\": true}\n\n"
-                            break
-                        yield line + "\n"
+            async for chunk in source:
+                await queue.put(chunk)
+        finally:
+            await queue.put(end)
+
+    task = asyncio.create_task(pump())
+    try:
+        while True:
+            try:
+                chunk = await asyncio.wait_for(queue.get(), CHAT_HEARTBEAT_INTERVAL)
+            except asyncio.TimeoutError:
+                if request is not None and await request.is_disconnected():
+                    return
+                yield SSE_HEARTBEAT_FRAME
+                continue
+            if chunk is end:
+                # Surface errors from the source the same way a plain generator would
+                await task
                 return
+            yield chunk
+    finally:
+        task.cancel()
+
+class ChatStreamFlight:
+    """One upstream generation fanned out to every identical in-flight request.
+
+    The upstream stream runs in its own task and appends frames to a shared
+    list; each subscriber replays the list from the start and then follows
+    it live, so late joiners still receive the whole answer.
+    """
+
+    def __init__(self, key: str, messages: List[dict]):
+        self.key = key
+        self.messages = messages
+        self.chunks: List[bytes] = []
+        self.done = False
+        self.subscribers = 0
+        self._changed = asyncio.Condition()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        try:
+            async for chunk in _iter_openrouter_stream(self.messages):
+                async with self._changed:
+                    self.chunks.append(chunk)
+                    self._changed.notify_all()
+            _remember_answer(self.key, self.chunks)
         except Exception as e:
-            logger.warning(f"OpenRouter attempt failed: {str(e)}")
-            continue
+            logger.error("Shared chat stream failed: %s", e)
+        finally:
+            if _chat_inflight.get(self.key) is self:
+                del _chat_inflight[self.key]
+            async with self._changed:
+                self.done = True
+                self._changed.notify_all()
+
+    def join(self):
+        """Count a new subscriber and return its stream of frames.
+
+        The count is taken here, when the request looks the flight up, not
+        when the response first iterates the stream: otherwise the last
+        active listener leaving in that gap would cancel the generation
+        under a request that has already joined it.
+        """
+        self.subscribers += 1
+        return self._follow()
+
+    async def _follow(self):
+        sent = 0
+        try:
+            while True:
+                async with self._changed:
+                    await self._changed.wait_for(lambda: sent < len(self.chunks) or self.done)
+                    pending = self.chunks[sent:]
+                    finished = self.done
+                for chunk in pending:
+                    yield chunk
+                sent += len(pending)
+                if finished and sent == len(self.chunks):
+                    return
+        finally:
+            self.subscribers -= 1
+            if self.subscribers == 0 and not self.done and self._task is not None:
+                # Last listener left: stop the generation, and make sure no new
+                # request joins a flight that is being cancelled
+                if _chat_inflight.get(self.key) is self:
+                    del _chat_inflight[self.key]
+                self._task.cancel()
+
+_chat_inflight: Dict[str, ChatStreamFlight] = {}
 
 @api_router.post("/chat/complete")
-async def chat_complete(req: ChatCompletionRequest):
+async def chat_complete(req: ChatCompletionRequest, request: Request):
     # If server has no OpenRouter keys configured, force client fallback
     if not OPENROUTER_API_KEYS:
         raise HTTPException(status_code=503, detail="llm-backend-unavailable")
 
+    messages = trim_context([m.model_dump() for m in req.messages], CHAT_CONTEXT_TOKEN_BUDGET,
+                            CHAT_CONTEXT_COMPACT_TOKENS)
+    cache_key = chat_cache_key(messages) if chat_cache is not None or CHAT_COALESCE_ENABLED else None
+    if chat_cache is not None:
+        cached = chat_cache.get(cache_key)
+        if cached is not None:
+            # Replay the stored frames exactly as the upstream stream produced them
+            return StreamingResponse(iter([cached]), media_type="text/event-stream",
+                                     headers={**SSE_HEADERS, "X-Chat-Cache": "hit"})
+
+    if CHAT_COALESCE_ENABLED:
+        flight = _chat_inflight.get(cache_key)
+        if flight is None:
+            flight = _chat_inflight[cache_key] = ChatStreamFlight(cache_key, messages)
+            flight.start()
+        return StreamingResponse(with_heartbeat(flight.join(), request), media_type="text/event-stream",
+                                 headers=SSE_HEADERS)
+
     async def event_generator():
-        stream = _iter_openrouter_stream([m.model_dump() for m in req.messages])
+        stream = _iter_openrouter_stream(messages)
         if stream is None:
             return
+        chunks = []
         async for chunk in stream:
+            chunks.append(chunk)
             yield chunk
-    return StreamingResponse(event_generator(), media_type="text/event-stream")
+        _remember_answer(cache_key, chunks)
+    return StreamingResponse(with_heartbeat(event_generator(), request), media_type="text/event-stream",
+                             headers=SSE_HEADERS)
+
+@api_router.get("/admin/write-behind")
+async def write_behind_stats(request: Request):
+    check_admin(request)
+    if write_behind is None:
+        return {"enabled": False}
+    return {"enabled": True, **write_behind.snapshot()}
+
+@api_router.get("/admin/chat-cache")
+async def chat_cache_stats(request: Request):
+    check_admin(request)
+    if chat_cache is None:
+        return {"enabled": False}
+    return {"enabled": True, **chat_cache.snapshot()}
+
+async def iter_csv_records(upload: UploadFile) -> AsyncIterator[List[str]]:
+    """Parse an uploaded CSV one read chunk at a time.
+
+    csv.reader decides where records end. The record ending on the last
+    line read so far may still continue in the next chunk (a quoted field
+    spanning lines), so its lines are kept and parsed again with it.
+    """
+    decoder = codecs.getincrementaldecoder("utf-8-sig")(errors="replace")
+    lines: List[str] = []
+    tail = ""
+    while True:
+        chunk = await upload.read(IMPORT_CHUNK_BYTES)
+        final = not chunk
+        text = tail + decoder.decode(chunk, final=final)
+        cut = len(text) if final else text.rfind("\n") + 1
+        start = 0
+        while start < cut:
+            end = text.find("\n", start, cut) + 1 or cut
+            lines.append(text[start:end])
+            start = end
+        tail = text[cut:]
+        reader = csv.reader(lines)
+        records = [(record, reader.line_num) for record in reader]
+        if not final and records:
+            # Possibly incomplete: parse it again once more lines are in
+            records.pop()
+        consumed = records[-1][1] if records else 0
+        for record, _ in records:
+            yield record
+        if final:
+            return
+        del lines[:consumed]
+
+class ImportSummary:
+    def __init__(self, table: str):
+        self.table = table
+        self.rows = 0
+        self.inserted = 0
+        self.duplicates_in_file = 0
+        self.duplicates_existing = 0
+        self.invalid = 0
+        self.invalid_rows: List[dict] = []
+
+    def reject(self, row_number: int, email: str, error: str):
+        self.invalid += 1
+        if len(self.invalid_rows) < IMPORT_MAX_REPORTED_ERRORS:
+            self.invalid_rows.append({"row": row_number, "email": email, "error": error})
+
+    def as_dict(self) -> dict:
+        return {
+            "table": self.table,
+            "rows": self.rows,
+            "inserted": self.inserted,
+            "duplicates": self.duplicates_in_file + self.duplicates_existing,
+            "duplicates_in_file": self.duplicates_in_file,
+            "duplicates_existing": self.duplicates_existing,
+            "invalid": self.invalid,
+            "invalid_rows": self.invalid_rows,
+        }
+
+async def _import_batch(table: str, models: Tuple[type, type], batch: List[Tuple[int, dict]], seen: set,
+                        summary: ImportSummary):
+    """Validate one batch in a single pass, drop repeats, and upsert the rest."""
+    create_model, model = models
+    adapter = _rows_adapter(create_model)
+    try:
+        validated = adapter.validate_python([raw for _, raw in batch])
+    except ValidationError as e:
+        bad: Dict[int, str] = {}
+        for err in e.errors():
+            bad.setdefault(err["loc"][0], err["msg"])
+        for index, message in bad.items():
+            row_number, raw = batch[index]
+            summary.reject(row_number, raw["email"], message)
+        validated = adapter.validate_python([raw for i, (_, raw) in enumerate(batch) if i not in bad])
+
+    rows = []
+    for item in validated:
+        data = model(**item.model_dump()).model_dump(mode="json")
+        # 8-byte digests keep the in-file dedupe set small for large files
+        digest = hashlib.blake2b(data["email"].lower().encode(), digest_size=8).digest()
+        if digest in seen:
+            summary.duplicates_in_file += 1
+            continue
+        seen.add(digest)
+        rows.append(data)
+    if rows:
+        inserted = await storage.insert_unique(table, rows, "email")
+        summary.inserted += len(inserted)
+        summary.duplicates_existing += len(rows) - len(inserted)
+        if inserted:
+            list_cache.invalidate(table)
+
+# (create model that validates the input, read model for the stored row)
+IMPORT_MODELS = {"leads": (LeadCreate, Lead), "newsletter": (NewsletterCreate, Newsletter)}
+
+@api_router.post("/admin/import/{table}")
+async def import_signups(request: Request, table: str, file: UploadFile = File(...),
+                         source: Optional[str] = Query(None, max_length=100)):
+    """Bulk-load a CSV with an `email` column (optional `source`) into leads or newsletter.
+
+    The upload is parsed incrementally and written in IMPORT_BATCH_SIZE
+    batches of ON CONFLICT (email) DO NOTHING, so memory stays flat apart
+    from the in-file dedupe set. `?source=` fills rows without one.
+    """
+    require_admin(request)
+    check_storage()
+    models = IMPORT_MODELS.get(table)
+    if models is None:
+        raise HTTPException(status_code=404, detail="unknown table")
+
+    records = iter_csv_records(file)
+    header = await anext(records, None)
+    columns = [h.strip().lower() for h in header or []]
+    if "email" not in columns:
+        raise HTTPException(status_code=400, detail="CSV needs a header row with an email column")
+    email_at = columns.index("email")
+    source_at = columns.index("source") if "source" in columns else None
+
+    summary = ImportSummary(table)
+    seen: set = set()
+    batch: List[Tuple[int, dict]] = []
+    try:
+        row_number = 1
+        async for values in records:
+            row_number += 1
+            if not any(v.strip() for v in values):
+                continue
+            summary.rows += 1
+            email = values[email_at].strip() if email_at < len(values) else ""
+            row_source = values[source_at].strip() if source_at is not None and source_at < len(values) else ""
+            batch.append((row_number, {"email": email, "source": row_source or source}))
+            if len(batch) >= IMPORT_BATCH_SIZE:
+                await _import_batch(table, models, batch, seen, summary)
+                batch = []
+        if batch:
+            await _import_batch(table, models, batch, seen, summary)
+    except csv.Error as e:
+        raise HTTPException(status_code=400, detail={"error": f"Malformed CSV: {str(e)}", **summary.as_dict()})
+    except Exception as e:
+        logger.error("Error importing %s: %s", table, e)
+        raise HTTPException(status_code=500, detail={"error": f"Database error: {str(e)}", **summary.as_dict()})
+
+    logger.info("Imported %s: %s inserted, %s duplicates, %s invalid", table, summary.inserted,
+                summary.duplicates_in_file + summary.duplicates_existing, summary.invalid)
+    return summary.as_dict()
+
+@api_router.get("/admin/openrouter/keys")
+async def openrouter_key_health(request: Request):
+    check_admin(request)
+    return {"keys": key_scheduler.snapshot(), "hedging": hedge_stats.snapshot()}
+
+# Health checks: /health is liveness (no I/O at all); /ready reports the last
+# result of a background dependency probe, so load balancer checks never add
+# DB or upstream load
+HEALTH_PROBE_INTERVAL = float(os.environ.get("HEALTH_PROBE_INTERVAL", "30"))
+
+class DependencyProbe:
+    """Periodically checks the storage backend and OpenRouter and caches the outcome."""
+
+    def __init__(self):
+        self.results: Dict[str, dict] = {}
+
+    async def _check(self, name: str, check):
+        t0 = time.perf_counter()
+        try:
+            await check()
+            result = {"ok": True}
+        except Exception as e:
+            result = {"ok": False, "error": str(e)[:200]}
+        result["latency_ms"] = round((time.perf_counter() - t0) * 1000, 1)
+        result["checked_at"] = datetime.now(timezone.utc).isoformat()
+        self.results[name] = result
+
+    async def _check_openrouter(self):
+        # Tiny authenticated GET with the healthiest key
+        r = await _get_openrouter_client().get(
+            OPENROUTER_KEY_CHECK_URL,
+            headers={"Authorization": f"Bearer {key_scheduler.ordered_keys()[0]}"},
+            timeout=10.0,
+        )
+        r.raise_for_status()
+
+    async def run_once(self):
+        checks = []
+        if storage.configured:
+            checks.append(self._check(storage.name, storage.ping))
+        if OPENROUTER_API_KEYS:
+            checks.append(self._check("openrouter", self._check_openrouter))
+        await asyncio.gather(*checks)
+
+    async def loop(self):
+        while True:
+            await self.run_once()
+            await asyncio.sleep(HEALTH_PROBE_INTERVAL)
+
+    def report(self) -> Tuple[bool, dict]:
+        checks = {}
+        ready = True
+        # Storage is required (every write needs it); OpenRouter is optional
+        # because the chat widget falls back client-side
+        for name, required, configured in ((storage.name, True, storage.configured),
+                                           ("openrouter", False, bool(OPENROUTER_API_KEYS))):
+            if not configured:
+                checks[name] = {"ok": None, "status": "not_configured"}
+                ready = ready and not required
+                continue
+            result = self.results.get(name)
+            if result is None:
+                checks[name] = {"ok": None, "status": "pending"}
+                ready = ready and not required
+                continue
+            checks[name] = dict(result)
+            ready = ready and (result["ok"] or not required)
+        if OPENROUTER_API_KEYS:
+            states = [k["state"] for k in key_scheduler.snapshot()]
+            checks.setdefault("openrouter", {})["healthy_keys"] = sum(st != "open" for st in states)
+        return ready, checks
+
+dependency_probe = DependencyProbe()
+
+@app.get("/health", include_in_schema=False)
+async def health():
+    return {"status": "ok"}
+
+@app.get("/ready", include_in_schema=False)
+async def ready():
+    is_ready, checks = dependency_probe.report()
+    return Response(
+        content=dumps({"status": "ready" if is_ready else "not_ready", "checks": checks}),
+        status_code=200 if is_ready else 503,
+        media_type="application/json",
+    )
 
 # Include the router in the main app
 app.include_router(api_router)
 
+# Rate limiting: token buckets per client and route. RATE_LIMITS is a comma
+# separated list of "<METHOD> <path>=<requests>/<seconds>"; the bucket holds
+# <requests> tokens and refills at <requests>/<seconds> per second
+DEFAULT_RATE_LIMITS = (
+    "POST /api/chat/complete=20/60,"
+    "POST /api/leads=10/60,"
+    "POST /api/newsletter=10/60,"
+    "POST /api/orders-intent=20/60,"
+    "POST /api/checkout/start=20/60"
+)
+# Off by default: behind a proxy every visitor shares the proxy's address until
+# RATE_LIMIT_KEY_HEADER is set, which would make the limits site-wide
+RATE_LIMIT_ENABLED = os.environ.get("RATE_LIMIT_ENABLED", "false").lower() in ("1", "true", "yes")
+# Header holding the client identity when behind a proxy (e.g. x-forwarded-for, cf-connecting-ip)
+RATE_LIMIT_KEY_HEADER = os.environ.get("RATE_LIMIT_KEY_HEADER", "").strip().lower()
+# Proxies we trust to append to that header. The client controls everything left
+# of what they added, so the key is the entry this many hops from the right
+RATE_LIMIT_TRUSTED_HOPS = max(1, int(os.environ.get("RATE_LIMIT_TRUSTED_HOPS", "1")))
+# "memory" is per worker; "supabase" shares buckets through the rate_limit_hit() SQL function
+RATE_LIMIT_STORE = os.environ.get("RATE_LIMIT_STORE", "memory").lower()
+RATE_LIMIT_MAX_CLIENTS = int(os.environ.get("RATE_LIMIT_MAX_CLIENTS", "100000"))
+
+def parse_rate_limits(spec: str) -> Dict[Tuple[str, str], Tuple[int, float]]:
+    limits = {}
+    for item in spec.split(","):
+        if not item.strip():
+            continue
+        try:
+            route, rate = item.rsplit("=", 1)
+            method, path = route.split()
+            requests_, seconds = rate.split("/")
+            limits[(method.upper(), path.rstrip("/") or "/")] = (int(requests_), float(seconds))
+        except ValueError:
+            logging.warning("Ignoring malformed RATE_LIMITS entry: %r", item)
+    return limits
+
+RATE_LIMITS = parse_rate_limits(os.environ.get("RATE_LIMITS", DEFAULT_RATE_LIMITS))
+
+class SupabaseRateLimitStore(RateLimitStore):
+    """Buckets shared by all workers via rate_limit_hit() (see DOCS/SUPABASE_SCHEMA.md)."""
+
+    async def hit(self, key: str, capacity: int, refill_per_sec: float) -> float:
+        result = await db_execute(supabase.rpc(
+            "rate_limit_hit", {"bucket_key": key, "capacity": capacity, "refill_per_sec": refill_per_sec}))
+        return float(result.data or 0)
+
+if RATE_LIMIT_STORE == "supabase" and SUPABASE_CONFIGURED:
+    rate_limit_store: RateLimitStore = SupabaseRateLimitStore()
+else:
+    if RATE_LIMIT_STORE == "supabase":
+        logging.warning("RATE_LIMIT_STORE=supabase but Supabase is not configured; buckets are kept per worker")
+    rate_limit_store = MemoryRateLimitStore(RATE_LIMIT_MAX_CLIENTS)
+
+if RATE_LIMIT_ENABLED and RATE_LIMITS:
+    app.add_middleware(RateLimitMiddleware, limits=RATE_LIMITS, store=rate_limit_store,
+                       key_header=RATE_LIMIT_KEY_HEADER, trusted_hops=RATE_LIMIT_TRUSTED_HOPS)
+
+# Response compression: bodies of at least COMPRESSION_MIN_SIZE bytes are sent
+# with brotli (when installed and accepted) or gzip. SSE is never compressed,
+# since a compressor buffers frames and would stall the chat stream
+COMPRESSION_ENABLED = os.environ.get("COMPRESSION_ENABLED", "true").lower() in ("1", "true", "yes")
+COMPRESSION_MIN_SIZE = int(os.environ.get("COMPRESSION_MIN_SIZE", "1024"))
+COMPRESSION_GZIP_LEVEL = int(os.environ.get("COMPRESSION_GZIP_LEVEL", "6"))
+COMPRESSION_BROTLI_QUALITY = int(os.environ.get("COMPRESSION_BROTLI_QUALITY", "4"))
+if COMPRESSION_ENABLED:
+    app.add_middleware(CompressionMiddleware, minimum_size=COMPRESSION_MIN_SIZE,
+                       gzip_level=COMPRESSION_GZIP_LEVEL, brotli_quality=COMPRESSION_BROTLI_QUALITY)
+
+app.add_middleware(MetricsMiddleware, requests=HTTP_REQUESTS, latency=HTTP_LATENCY, in_flight=HTTP_IN_FLIGHT,
+                   route_var=_log_route)
+
+@app.get("/metrics", include_in_schema=False)
+async def prometheus_metrics():
+    return Response(content=metrics.render(), media_type=METRICS_CONTENT_TYPE)
+
 # CORS configuration
 allowed = os.environ.get("ALLOWED_ORIGINS", "").strip()
 origins = [o.strip() for o in allowed.split(",") if o.strip()] or ["*"]
@@ -342,4 +2196,5 @@ app.add_middleware(
     allow_origins=origins,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "ETag", "Idempotent-Replayed", "Retry-After"],
 )
@@ -0,0 +1,360 @@
+"""Storage repository for the app tables: Supabase (PostgREST), SQLite and in-memory backends.
+
+server.py picks one with STORAGE_BACKEND; request handlers only see the
+`Storage` interface.
+"""
+import asyncio
+import logging
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from abc import ABC, abstractmethod
+from typing import TYPE_CHECKING, Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+if TYPE_CHECKING:
+    from postgrest import AsyncPostgrestClient
+
+logger = logging.getLogger(__name__)
+
+
+class Storage(ABC):
+    """Repository for the app tables (leads, newsletter, order_intents, status_checks).
+
+    Rows are plain dicts in the models' JSON shape. Lists are keyset pages
+    ordered by (time column, id) descending, `after` being the last row's pair.
+    """
+
+    name = ""
+    label = ""
+
+    @property
+    def configured(self) -> bool:
+        return True
+
+    async def open(self):
+        pass
+
+    @abstractmethod
+    async def insert(self, table: str, rows: List[dict]):
+        """Insert rows; a duplicate value in a unique column is an error."""
+
+    @abstractmethod
+    async def insert_unique(self, table: str, rows: List[dict], column: str, returning: bool = True) -> List[dict]:
+        """Insert rows whose `column` value is not stored yet (ON CONFLICT DO NOTHING).
+
+        Returns the rows actually inserted (nothing when `returning` is False).
+        """
+
+    @abstractmethod
+    async def find(self, table: str, column: str, value) -> Optional[dict]:
+        """First row whose `column` equals `value`, or None."""
+
+    @abstractmethod
+    async def fetch_page(self, table: str, time_col: str, limit: int,
+                         after: Optional[Tuple[str, str]] = None) -> List[dict]:
+        """Up to `limit` rows, newest first, strictly after the `after` keyset position."""
+
+    @abstractmethod
+    async def stats(self, since: str) -> dict:
+        """Aggregates for /api/stats, computed where the data lives.
+
+        Signup tables get a total plus counts per (UTC day, source) from
+        `since` (YYYY-MM-DD) on; order_intents get a total plus count and
+        price sum per currency.
+        """
+
+    async def ping(self):
+        """Raise if the backend can't serve queries."""
+
+    async def close(self):
+        pass
+
+
+class SupabaseStorage(Storage):
+    """Tables behind PostgREST.
+
+    `client` returns the current PostgREST client (None until the app has
+    started) and `execute` runs a query builder, so connection setup,
+    concurrency limits and metrics stay with the app.
+    """
+
+    name = "supabase"
+    label = "Supabase PostgreSQL"
+
+    def __init__(self, client: Callable[[], Optional["AsyncPostgrestClient"]],
+                 execute: Callable[[Any], Awaitable[Any]]):
+        self._client = client
+        self._execute = execute
+
+    @property
+    def configured(self) -> bool:
+        return self._client() is not None
+
+    async def insert(self, table: str, rows: List[dict]):
+        from postgrest.types import ReturnMethod
+        await self._execute(self._client().table(table).insert(rows, returning=ReturnMethod.minimal))
+
+    async def insert_unique(self, table: str, rows: List[dict], column: str, returning: bool = True) -> List[dict]:
+        """Single INSERT ... ON CONFLICT DO NOTHING round trip.
+
+        Needs the unique index from DOCS/SUPABASE_SCHEMA.md; without it we fall
+        back to select-then-insert per row (racy under concurrent submits).
+        """
+        from postgrest.exceptions import APIError
+        from postgrest.types import ReturnMethod
+        try:
+            result = await self._execute(self._client().table(table).upsert(
+                rows, ignore_duplicates=True, on_conflict=column,
+                returning=ReturnMethod.representation if returning else ReturnMethod.minimal))
+            return result.data if returning else []
+        except APIError as e:
+            # 42P10: no unique constraint matches ON CONFLICT (column)
+            if e.code != "42P10":
+                raise
+            logger.warning("No unique index on %s.%s; using select-then-insert", table, column)
+        inserted = []
+        for row in rows:
+            if await self.find(table, column, row[column]) is None:
+                await self.insert(table, [row])
+                inserted.append(row)
+        return inserted if returning else []
+
+    async def find(self, table: str, column: str, value) -> Optional[dict]:
+        result = await self._execute(self._client().table(table).select('*').eq(column, value).limit(1))
+        return result.data[0] if result.data else None
+
+    async def fetch_page(self, table: str, time_col: str, limit: int,
+                         after: Optional[Tuple[str, str]] = None) -> List[dict]:
+        query = self._client().table(table).select('*').order(time_col, desc=True).order('id', desc=True).limit(limit)
+        if after:
+            ts, row_id = after
+            query = query.or_(f'{time_col}.lt."{ts}",and({time_col}.eq."{ts}",id.lt."{row_id}")')
+        result = await self._execute(query)
+        return result.data
+
+    async def stats(self, since: str) -> dict:
+        # app_stats() from DOCS/SUPABASE_SCHEMA.md does the GROUP BYs in Postgres
+        result = await self._execute(self._client().rpc("app_stats", {"since": since}))
+        return result.data
+
+    async def ping(self):
+        await self._execute(self._client().table('status_checks').select('id').limit(1))
+
+
+# Columns with a unique index, per table; SQLITE_SCHEMA and MemoryStorage both
+# enforce these (Supabase: see DOCS/SUPABASE_SCHEMA.md)
+UNIQUE_COLUMNS: Dict[str, Tuple[str, ...]] = {"leads": ("email",), "newsletter": ("email",)}
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS leads (
+  id TEXT PRIMARY KEY, email TEXT NOT NULL UNIQUE, source TEXT, created_at TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS newsletter (
+  id TEXT PRIMARY KEY, email TEXT NOT NULL UNIQUE, source TEXT, created_at TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS order_intents (
+  id TEXT PRIMARY KEY, price REAL NOT NULL, currency TEXT NOT NULL, note TEXT, email TEXT,
+  created_at TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS status_checks (
+  id TEXT PRIMARY KEY, client_name TEXT NOT NULL, timestamp TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS leads_created_id_idx ON leads (created_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS newsletter_created_id_idx ON newsletter (created_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS order_intents_created_id_idx ON order_intents (created_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS status_checks_timestamp_id_idx ON status_checks (timestamp DESC, id DESC);
+"""
+
+
+class SQLiteStorage(Storage):
+    """Embedded SQLite file in WAL mode.
+
+    The connection lives on one dedicated thread and every statement runs
+    there. A locked database (another worker writing, a WAL checkpoint) can
+    then stall storage calls for up to busy_timeout, but never the event
+    loop or the chat streams it is serving.
+    """
+
+    name = "sqlite"
+    label = "SQLite"
+
+    def __init__(self, path: str, busy_timeout_ms: int = 5000):
+        self.path = path
+        self.busy_timeout_ms = busy_timeout_ms
+        self._conn: Optional[sqlite3.Connection] = None
+        # A single worker serialises statements, as one connection requires
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+
+    async def _run(self, fn: Callable, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        # Only touched from the executor thread
+        if self._conn is None:
+            conn = sqlite3.connect(self.path)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(f"PRAGMA busy_timeout={int(self.busy_timeout_ms)}")
+            conn.executescript(SQLITE_SCHEMA)
+            self._conn = conn
+        return self._conn
+
+    @staticmethod
+    def _insert_sql(table: str, row: dict, verb: str = "INSERT") -> str:
+        columns = ", ".join(f'"{c}"' for c in row)
+        return f'{verb} INTO "{table}" ({columns}) VALUES ({", ".join("?" * len(row))})'
+
+    def _insert(self, table: str, rows: List[dict]):
+        with self.conn as conn:
+            for row in rows:
+                conn.execute(self._insert_sql(table, row), tuple(row.values()))
+
+    async def insert(self, table: str, rows: List[dict]):
+        await self._run(self._insert, table, rows)
+
+    def _insert_unique(self, table: str, rows: List[dict]) -> List[dict]:
+        # Every unique-inserted column has a UNIQUE constraint in SQLITE_SCHEMA
+        inserted = []
+        with self.conn as conn:
+            for row in rows:
+                if conn.execute(self._insert_sql(table, row, "INSERT OR IGNORE"), tuple(row.values())).rowcount:
+                    inserted.append(row)
+        return inserted
+
+    async def insert_unique(self, table: str, rows: List[dict], column: str, returning: bool = True) -> List[dict]:
+        inserted = await self._run(self._insert_unique, table, rows)
+        return inserted if returning else []
+
+    def _find(self, table: str, column: str, value) -> Optional[dict]:
+        row = self.conn.execute(f'SELECT * FROM "{table}" WHERE "{column}" = ? LIMIT 1', (value,)).fetchone()
+        return dict(row) if row is not None else None
+
+    async def find(self, table: str, column: str, value) -> Optional[dict]:
+        return await self._run(self._find, table, column, value)
+
+    def _fetch_page(self, table: str, time_col: str, limit: int,
+                    after: Optional[Tuple[str, str]]) -> List[dict]:
+        where, params = "", ()
+        if after:
+            where, params = f'WHERE ("{time_col}", id) < (?, ?)', after
+        rows = self.conn.execute(
+            f'SELECT * FROM "{table}" {where} ORDER BY "{time_col}" DESC, id DESC LIMIT ?', (*params, limit))
+        return [dict(row) for row in rows]
+
+    async def fetch_page(self, table: str, time_col: str, limit: int,
+                         after: Optional[Tuple[str, str]] = None) -> List[dict]:
+        return await self._run(self._fetch_page, table, time_col, limit, after)
+
+    async def open(self):
+        # Connect and create the schema at startup rather than on the first request
+        await self.ping()
+
+    def _stats(self, since: str) -> dict:
+        conn = self.conn
+        stats = {}
+        for table in ("leads", "newsletter"):
+            rows = conn.execute(
+                f'SELECT substr(created_at, 1, 10) AS day, source, COUNT(*) AS count FROM "{table}" '
+                'WHERE created_at >= ? GROUP BY day, source ORDER BY day, source', (since,))
+            total = conn.execute(f'SELECT COUNT(*) FROM "{table}"').fetchone()[0]
+            stats[table] = {"total": total, "by_day": [dict(row) for row in rows]}
+        rows = conn.execute(
+            "SELECT currency, COUNT(*) AS count, SUM(price) AS sum FROM order_intents "
+            "GROUP BY currency ORDER BY currency")
+        by_currency = [dict(row) for row in rows]
+        stats["order_intents"] = {"total": sum(r["count"] for r in by_currency), "by_currency": by_currency}
+        return stats
+
+    async def stats(self, since: str) -> dict:
+        return await self._run(self._stats, since)
+
+    def _ping(self):
+        self.conn.execute("SELECT 1")
+
+    async def ping(self):
+        await self._run(self._ping)
+
+    def _close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    async def close(self):
+        await self._run(self._close)
+
+
+class MemoryStorage(Storage):
+    """Per-process tables in dicts; nothing survives a restart."""
+
+    name = "memory"
+    label = "In-memory"
+
+    def __init__(self):
+        self._rows: Dict[str, Dict[str, dict]] = {}
+        # (table, column) -> value -> row for every UNIQUE_COLUMNS entry,
+        # maintained by insert() so both insert paths see the same index
+        self._unique: Dict[Tuple[str, str], Dict[object, dict]] = {
+            (table, column): {} for table, columns in UNIQUE_COLUMNS.items() for column in columns
+        }
+
+    def _indexes(self, table: str) -> List[Tuple[str, Dict[object, dict]]]:
+        return [(column, index) for (t, column), index in self._unique.items() if t == table]
+
+    async def insert(self, table: str, rows: List[dict]):
+        indexes = self._indexes(table)
+        # Check the whole batch first so a violation leaves nothing half-inserted
+        for column, index in indexes:
+            values = [row.get(column) for row in rows]
+            if any(v in index for v in values) or len(set(values)) < len(values):
+                raise ValueError(f"duplicate value in unique column {table}.{column}")
+        stored = self._rows.setdefault(table, {})
+        for row in rows:
+            stored[row["id"]] = dict(row)
+            for column, index in indexes:
+                index[row.get(column)] = stored[row["id"]]
+
+    async def insert_unique(self, table: str, rows: List[dict], column: str, returning: bool = True) -> List[dict]:
+        index = self._unique[(table, column)]
+        inserted = []
+        for row in rows:
+            if row[column] not in index:
+                await self.insert(table, [row])
+                inserted.append(row)
+        return inserted if returning else []
+
+    async def find(self, table: str, column: str, value) -> Optional[dict]:
+        index = self._unique.get((table, column))
+        if index is not None:
+            row = index.get(value)
+        else:
+            row = next((r for r in self._rows.get(table, {}).values() if r.get(column) == value), None)
+        return dict(row) if row is not None else None
+
+    async def fetch_page(self, table: str, time_col: str, limit: int,
+                         after: Optional[Tuple[str, str]] = None) -> List[dict]:
+        rows = sorted(self._rows.get(table, {}).values(), key=lambda r: (r[time_col], r["id"]), reverse=True)
+        if after:
+            rows = [r for r in rows if (r[time_col], r["id"]) < after]
+        return [dict(r) for r in rows[:limit]]
+
+    async def stats(self, since: str) -> dict:
+        stats = {}
+        for table in ("leads", "newsletter"):
+            rows = self._rows.get(table, {}).values()
+            counts: Dict[Tuple[str, Optional[str]], int] = {}
+            for row in rows:
+                day = row["created_at"][:10]
+                if day >= since:
+                    counts[(day, row.get("source"))] = counts.get((day, row.get("source")), 0) + 1
+            stats[table] = {
+                "total": len(rows),
+                "by_day": [{"day": day, "source": source, "count": n}
+                           for (day, source), n in sorted(counts.items(), key=lambda kv: (kv[0][0], kv[0][1] or ""))],
+            }
+        currencies: Dict[str, list] = {}
+        for row in self._rows.get("order_intents", {}).values():
+            entry = currencies.setdefault(row["currency"], [0, 0.0])
+            entry[0] += 1
+            entry[1] += row["price"]
+        stats["order_intents"] = {
+            "total": sum(n for n, _ in currencies.values()),
+            "by_currency": [{"currency": c, "count": n, "sum": total} for c, (n, total) in sorted(currencies.items())],
+        }
+        return stats
@@ -0,0 +1,32 @@
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+# server.py reads its configuration at import time: run it on the in-memory
+# backend, without rate limiting or background logging threads
+os.environ.update(
+    STORAGE_BACKEND="memory",
+    RATE_LIMIT_ENABLED="false",
+    LOG_QUEUE_ENABLED="false",
+    LOG_LEVEL="WARNING",
+)
+os.environ.pop("SUPABASE_URL", None)
+os.environ.pop("ADMIN_API_KEY", None)
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import server  # noqa: E402
+from storage import MemoryStorage  # noqa: E402
+
+
+@pytest.fixture
+def app(monkeypatch):
+    """The server module with fresh in-memory tables and caches."""
+    monkeypatch.setattr(server, "storage", MemoryStorage())
+    monkeypatch.setattr(server, "known_emails", {
+        table: server.KnownEmailCache(server.KNOWN_EMAIL_CACHE_SIZE) for table in server.known_emails
+    })
+    for table in ("leads", "newsletter", "order_intents", "status_checks"):
+        server.list_cache.invalidate(table)
+    return server
@@ -0,0 +1,88 @@
+import asyncio
+
+import pytest
+
+
+@pytest.fixture
+def upstream(app, monkeypatch):
+    """Replace the OpenRouter stream with one that yields a frame per `release` set."""
+    state = {"calls": 0, "cancelled": False, "release": None}
+
+    async def fake_stream(messages):
+        state["calls"] += 1
+        try:
+            for frame in (b"data: a\n\n", b"data: b\n\n", app.SSE_DONE_FRAME):
+                await state["release"].wait()
+                state["release"].clear()
+                yield frame
+        except asyncio.CancelledError:
+            state["cancelled"] = True
+            raise
+    monkeypatch.setattr(app, "_iter_openrouter_stream", fake_stream)
+    monkeypatch.setattr(app, "_chat_inflight", {})
+    return state
+
+
+def start_flight(server, state, key="k"):
+    state["release"] = asyncio.Event()
+    flight = server._chat_inflight[key] = server.ChatStreamFlight(key, [])
+    flight.start()
+    return flight
+
+
+async def drain(stream):
+    return [chunk async for chunk in stream]
+
+
+def test_flight_fans_out_one_generation(app, upstream):
+    async def main():
+        flight = start_flight(app, upstream)
+        first, second = flight.join(), flight.join()
+        readers = asyncio.gather(drain(first), drain(second))
+        for _ in range(3):
+            await asyncio.sleep(0.01)
+            upstream["release"].set()
+        late = await drain(flight.join())
+        return await readers, late
+
+    (first, second), late = asyncio.run(main())
+    assert first == second == late == [b"data: a\n\n", b"data: b\n\n", app.SSE_DONE_FRAME]
+    assert upstream["calls"] == 1
+    assert app._chat_inflight == {}
+
+
+def test_last_subscriber_leaving_cancels_flight(app, upstream):
+    async def main():
+        flight = start_flight(app, upstream)
+        only = flight.join()
+        upstream["release"].set()
+        assert await only.__anext__() == b"data: a\n\n"
+        await only.aclose()
+        await asyncio.sleep(0.01)
+        return flight
+
+    flight = asyncio.run(main())
+    assert upstream["cancelled"]
+    assert flight.subscribers == 0
+    assert app._chat_inflight == {}
+
+
+def test_joined_but_unstarted_subscriber_keeps_flight_alive(app, upstream):
+    async def main():
+        flight = start_flight(app, upstream)
+        leaving = flight.join()
+        upstream["release"].set()
+        await leaving.__anext__()
+        # A second request joins before its response starts iterating
+        joined = flight.join()
+        await leaving.aclose()
+        await asyncio.sleep(0.01)
+        assert not upstream["cancelled"]
+        reader = asyncio.ensure_future(drain(joined))
+        for _ in range(2):
+            await asyncio.sleep(0.01)
+            upstream["release"].set()
+        return await reader
+
+    assert asyncio.run(main()) == [b"data: a\n\n", b"data: b\n\n", app.SSE_DONE_FRAME]
+    assert not upstream["cancelled"]
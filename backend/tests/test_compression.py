@@ -0,0 +1,43 @@
+import asyncio
+
+from fastapi.testclient import TestClient
+from starlette.applications import Starlette
+from starlette.responses import StreamingResponse
+from starlette.routing import Route
+
+from middleware import CompressionMiddleware
+
+
+def test_event_stream_is_not_compressed():
+    async def frames():
+        for i in range(50):
+            yield f"data: {'x' * 100} {i}\n\n".encode()
+
+    async def stream(request):
+        return StreamingResponse(frames(), media_type="text/event-stream")
+
+    app = Starlette(routes=[Route("/stream", stream)])
+    app.add_middleware(CompressionMiddleware, minimum_size=10)
+    with TestClient(app) as client:
+        resp = client.get("/stream", headers={"Accept-Encoding": "gzip"})
+    assert resp.status_code == 200
+    assert "content-encoding" not in resp.headers
+    assert resp.text.count("data: ") == 50
+
+
+def test_compressed_list_gets_weak_etag_that_revalidates(app):
+    rows = [{"id": f"{i:08d}-0000-0000-0000-000000000000", "email": f"user{i}@example.com", "source": "site",
+             "created_at": "2025-01-01T00:00:00+00:00"} for i in range(40)]
+    asyncio.run(app.storage.insert("leads", rows))
+
+    with TestClient(app.app) as client:
+        resp = client.get("/api/leads", headers={"Accept-Encoding": "gzip"})
+        assert resp.status_code == 200
+        assert resp.headers["content-encoding"] == "gzip"
+        assert len(resp.json()) == 40
+        etag = resp.headers["etag"]
+        assert etag.startswith('W/"')
+
+        again = client.get("/api/leads", headers={"Accept-Encoding": "gzip", "If-None-Match": etag})
+    assert again.status_code == 304
+    assert again.content == b""
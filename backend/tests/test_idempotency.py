@@ -0,0 +1,103 @@
+import asyncio
+
+import httpx
+import pytest
+
+ORDER = {"price": 10, "currency": "BRL"}
+
+
+def post_orders(server, *requests):
+    """POST every (json, key) pair to /api/orders-intent concurrently."""
+    async def main():
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            return await asyncio.gather(*(
+                client.post("/api/orders-intent", json=body, headers={"Idempotency-Key": key})
+                for body, key in requests))
+    return asyncio.run(main())
+
+
+def stored_orders(server):
+    return asyncio.run(server.storage.fetch_page("order_intents", "created_at", 10))
+
+
+@pytest.fixture
+def idem(app, monkeypatch):
+    monkeypatch.setattr(app, "idempotency_store", app.MemoryIdempotencyStore(60, 100))
+    monkeypatch.setattr(app, "_idempotency_inflight", {})
+    insert = app.storage.insert
+
+    async def slow_insert(table, rows):
+        # Keep the first request in flight while its duplicates arrive
+        await asyncio.sleep(0.05)
+        return await insert(table, rows)
+    monkeypatch.setattr(app.storage, "insert", slow_insert)
+    return app
+
+
+def test_concurrent_same_key_inserts_once(idem):
+    responses = post_orders(idem, *[(ORDER, "k1")] * 4)
+    assert {r.status_code for r in responses} == {201}
+    assert len({r.json()["id"] for r in responses}) == 1
+    assert sum(r.headers.get("Idempotent-Replayed") == "true" for r in responses) == 3
+    assert len(stored_orders(idem)) == 1
+
+
+def test_key_reused_with_different_payload(idem):
+    first, second = post_orders(idem, (ORDER, "k2"), ({"price": 99, "currency": "BRL"}, "k2"))
+    assert first.status_code == 201
+    assert second.status_code == 422
+    (later,) = post_orders(idem, ({"price": 99, "currency": "BRL"}, "k2"))
+    assert later.status_code == 422
+
+
+def test_failed_first_attempt_can_be_retried(idem, monkeypatch):
+    insert = idem.storage.insert
+    attempts = []
+
+    async def flaky_insert(table, rows):
+        attempts.append(rows)
+        if len(attempts) == 1:
+            raise RuntimeError("database unavailable")
+        return await insert(table, rows)
+    monkeypatch.setattr(idem.storage, "insert", flaky_insert)
+
+    (failed,) = post_orders(idem, (ORDER, "k3"))
+    assert failed.status_code == 500
+    (retried,) = post_orders(idem, (ORDER, "k3"))
+    assert retried.status_code == 201
+    assert "Idempotent-Replayed" not in retried.headers
+    assert len(stored_orders(idem)) == 1
+
+
+def test_failing_release_does_not_strand_duplicates(idem, monkeypatch):
+    async def failing_insert(table, rows):
+        await asyncio.sleep(0.05)
+        raise RuntimeError("database unavailable")
+
+    async def failing_release(key):
+        raise RuntimeError("store unavailable")
+    monkeypatch.setattr(idem.storage, "insert", failing_insert)
+    monkeypatch.setattr(idem.idempotency_store, "release", failing_release)
+    monkeypatch.setattr(idem, "IDEMPOTENCY_WAIT", 0.5)
+
+    responses = asyncio.run(asyncio.wait_for(
+        asyncio.to_thread(post_orders, idem, (ORDER, "k4"), (ORDER, "k4")), timeout=5))
+    assert responses[0].status_code == 500
+    # The claim was never released, so the duplicate gives up after the wait
+    assert responses[1].status_code == 409
+    assert idem._idempotency_inflight == {}
+
+
+def test_queued_response_is_not_replayed(idem, monkeypatch):
+    monkeypatch.setattr(idem, "WRITE_BEHIND_ENABLED", True)
+    monkeypatch.setattr(idem, "WRITE_BEHIND_DURABILITY", "memory")
+
+    async def scenario():
+        async with idem.lifespan(idem.app):
+            transport = httpx.ASGITransport(app=idem.app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+                return await client.post("/api/orders-intent", json=ORDER, headers={"Idempotency-Key": "k5"})
+
+    assert asyncio.run(scenario()).status_code == 202
+    assert asyncio.run(idem.idempotency_store.get("orders-intent:k5")) is None
@@ -0,0 +1,57 @@
+import pytest
+from fastapi.testclient import TestClient
+
+ADMIN = {"x-admin-key": "test-admin-key"}
+
+
+@pytest.fixture
+def admin(app, monkeypatch):
+    monkeypatch.setattr(app, "ADMIN_API_KEY", ADMIN["x-admin-key"])
+    return app
+
+
+def upload(server, body: bytes, table: str = "leads", headers=ADMIN):
+    with TestClient(server.app) as client:
+        resp = client.post(f"/api/admin/import/{table}", headers=headers,
+                           files={"file": ("import.csv", body, "text/csv")})
+        emails = sorted(row["email"] for row in client.get(f"/api/{table}", headers=ADMIN).json())
+    return resp, emails
+
+
+@pytest.mark.parametrize("chunk_bytes", [7, 64 * 1024])
+def test_quote_inside_unquoted_field_keeps_following_rows(admin, monkeypatch, chunk_bytes):
+    monkeypatch.setattr(admin, "IMPORT_CHUNK_BYTES", chunk_bytes)
+    resp, emails = upload(admin, b'email\nfoo"bar@example.com\nz1@example.com\nz2@example.com\n')
+    assert resp.status_code == 200
+    summary = resp.json()
+    assert summary["rows"] == 3
+    assert summary["invalid"] == 1
+    assert emails == ["z1@example.com", "z2@example.com"]
+
+
+@pytest.mark.parametrize("chunk_bytes", [5, 16, 64 * 1024])
+def test_multiline_and_escaped_quotes_across_chunks(admin, monkeypatch, chunk_bytes):
+    monkeypatch.setattr(admin, "IMPORT_CHUNK_BYTES", chunk_bytes)
+    body = ('﻿Email,Source,Note\r\n'
+            'a@example.com,site,"line one\nline two\nline three"\r\n'
+            'b@example.com,"say ""hi""","x"\r\n'
+            '"c@example.com",,"ends, with comma"\r\n'
+            'd@example.com').encode()
+    resp, emails = upload(admin, body)
+    assert resp.status_code == 200
+    assert resp.json()["rows"] == 4
+    assert resp.json()["inserted"] == 4
+    assert emails == ["a@example.com", "b@example.com", "c@example.com", "d@example.com"]
+
+
+def test_import_refused_without_configured_admin_key(app, monkeypatch):
+    monkeypatch.setattr(app, "ADMIN_API_KEY", "")
+    resp, emails = upload(app, b"email\na@example.com\n", headers={})
+    assert resp.status_code == 503
+    assert emails == []
+
+
+def test_import_requires_matching_admin_key(admin):
+    resp, emails = upload(admin, b"email\na@example.com\n", headers={"x-admin-key": "wrong"})
+    assert resp.status_code == 401
+    assert emails == []
@@ -0,0 +1,34 @@
+import base64
+import json
+import uuid
+
+import pytest
+from fastapi.testclient import TestClient
+
+
+def make_cursor(ts, row_id) -> str:
+    return base64.urlsafe_b64encode(json.dumps([ts, row_id]).encode()).decode().rstrip("=")
+
+
+def test_cursor_pages_through_table(app):
+    with TestClient(app.app) as client:
+        for i in range(3):
+            assert client.post("/api/status", json={"client_name": f"c{i}"}).status_code == 200
+        first = client.get("/api/status?limit=2")
+        cursor = first.headers["x-next-cursor"]
+        second = client.get(f"/api/status?limit=2&cursor={cursor}")
+    assert second.status_code == 200
+    seen = [r["id"] for r in first.json() + second.json()]
+    assert len(seen) == len(set(seen)) == 3
+
+
+@pytest.mark.parametrize("cursor", [
+    make_cursor('2025-01-01T00:00:00",id.gt."0', str(uuid.uuid4())),
+    make_cursor("2025-01-01T00:00:00+00:00", 'x"),and(id.gt.'),
+    make_cursor(123, str(uuid.uuid4())),
+    "not-base64-json",
+])
+def test_malformed_cursor_is_rejected(app, cursor):
+    with TestClient(app.app) as client:
+        resp = client.get("/api/status", params={"cursor": cursor})
+    assert resp.status_code == 400
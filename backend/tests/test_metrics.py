@@ -0,0 +1,17 @@
+from fastapi.testclient import TestClient
+
+
+def test_parameterised_routes_get_their_template_label(app):
+    with TestClient(app.app) as client:
+        client.post("/api/admin/import/leads", files={"file": ("l.csv", b"email\n", "text/csv")})
+        client.get("/api/")
+        client.get("/wp-login.php")
+    assert app.HTTP_LATENCY._counts.get(("POST", "/api/admin/import/{table}"))
+    assert app.HTTP_LATENCY._counts.get(("GET", "/api/"))
+    assert app.HTTP_LATENCY._counts.get(("GET", "unmatched"))
+
+
+def test_log_route_context_uses_template(app):
+    scope = {"type": "http", "method": "POST", "path": "/api/admin/import/newsletter", "headers": [], "app": app.app}
+    middleware = app.MetricsMiddleware(None, app.HTTP_REQUESTS, app.HTTP_LATENCY, app.HTTP_IN_FLIGHT)
+    assert middleware.route_label(scope) == "/api/admin/import/{table}"
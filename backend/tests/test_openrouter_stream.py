@@ -0,0 +1,175 @@
+import asyncio
+
+import httpx
+import pytest
+
+KEYS = ["key-a", "key-b"]
+MESSAGES = [{"role": "user", "content": "oi"}]
+
+
+class FakeStream(httpx.AsyncByteStream):
+    """Upstream body: bytes are sent as-is, awaitables are awaited in between."""
+
+    def __init__(self, key, parts, log):
+        self.key = key
+        self.parts = parts
+        self.log = log
+
+    async def __aiter__(self):
+        for part in self.parts:
+            if isinstance(part, bytes):
+                self.log["sent"].append(self.key)
+                yield part
+            else:
+                await part
+
+    async def aclose(self):
+        self.log["closed"].append(self.key)
+
+
+@pytest.fixture
+def openrouter(app, monkeypatch):
+    """Serve OpenRouter from `routes[key]`: a list of body parts, or an int status to reject with."""
+    routes = {}
+    log = {"requests": [], "sent": [], "closed": []}
+
+    async def handler(request):
+        key = request.headers["authorization"].removeprefix("Bearer ")
+        log["requests"].append(key)
+        route = routes[key]
+        if isinstance(route, int):
+            return httpx.Response(route, json={"error": "rejected"})
+        parts = route() if callable(route) else route
+        return httpx.Response(200, headers={"content-type": "text/event-stream"},
+                              stream=FakeStream(key, parts, log))
+
+    monkeypatch.setattr(app, "OPENROUTER_API_KEYS", KEYS)
+    monkeypatch.setattr(app, "key_scheduler", app.OpenRouterKeyScheduler(KEYS))
+    monkeypatch.setattr(app, "hedge_stats", app.HedgeStats())
+    monkeypatch.setattr(app, "OPENROUTER_HEDGE_ENABLED", True)
+    monkeypatch.setattr(app, "OPENROUTER_HEDGE_AFTER", 0.05)
+    monkeypatch.setattr(app, "_openrouter_client",
+                        httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+    return routes, log
+
+
+async def collect(stream):
+    return [frame async for frame in stream]
+
+
+def run(coro):
+    async def main():
+        result = await coro
+        # Let aclose() tasks scheduled by the race settle
+        await asyncio.sleep(0.02)
+        return result
+    return asyncio.run(main())
+
+
+def test_hedge_wins_and_loser_is_closed(app, openrouter):
+    routes, log = openrouter
+    routes["key-a"] = lambda: [asyncio.sleep(5), b"data: slow\n\n"]
+    routes["key-b"] = [b"data: fast\n\n", b"data: [DONE]\n\n"]
+
+    frames = run(collect(app._iter_openrouter_stream(MESSAGES)))
+    assert frames == [b"data: fast\n\n", app.SSE_DONE_FRAME]
+    assert log["requests"] == ["key-a", "key-b"]
+    assert "key-a" not in log["sent"]
+    assert sorted(log["closed"]) == ["key-a", "key-b"]
+    assert app.hedge_stats.hedge_wins == 1
+
+
+def test_falls_back_to_next_key_after_rejection(app, openrouter):
+    routes, log = openrouter
+    routes["key-a"] = 429
+    routes["key-b"] = [b"data: ok\n\n", b"data: [DONE]\n\n"]
+
+    frames = run(collect(app._iter_openrouter_stream(MESSAGES)))
+    assert frames == [b"data: ok\n\n", app.SSE_DONE_FRAME]
+    assert log["requests"] == ["key-a", "key-b"]
+    snapshot = {h["index"]: h for h in app.key_scheduler.snapshot()}
+    assert snapshot[0]["state"] == "open"
+    assert snapshot[0]["last_status"] == 429
+    assert app.hedge_stats.hedged == 0
+
+
+def test_attempt_finishing_in_the_same_wait_is_closed(app, openrouter, monkeypatch):
+    routes, log = openrouter
+    answer = asyncio.Event()
+
+    def hedge():
+        # Both attempts get their first token once the hedge has started
+        answer.set()
+        return [b"data: b\n\n", b"data: [DONE]\n\n"]
+    routes["key-a"] = lambda: [answer.wait(), b"data: a\n\n", b"data: [DONE]\n\n"]
+    routes["key-b"] = hedge
+    attempts = []
+
+    class KeptAttempt(app._UpstreamAttempt):
+        # Hold every attempt so garbage collection cannot close the loser for us
+        def __init__(self, *args):
+            super().__init__(*args)
+            attempts.append(self)
+    monkeypatch.setattr(app, "_UpstreamAttempt", KeptAttempt)
+
+    async def scenario():
+        frames = await collect(app._iter_openrouter_stream(MESSAGES))
+        await asyncio.sleep(0.02)
+        return frames, sorted(log["closed"])
+
+    frames, closed = asyncio.run(scenario())
+    assert len(attempts) == 2
+    winner = "key-a" if frames[0] == b"data: a\n\n" else "key-b"
+    # The loser produced its first token too, and was still closed
+    assert KEYS[1 - KEYS.index(winner)] in log["sent"]
+    assert closed == ["key-a", "key-b"]
+
+
+def test_frames_are_whole_events_and_end_at_done(app, openrouter):
+    routes, log = openrouter
+    routes["key-a"] = [
+        b": OPENROUTER PROCESSING\n\n",
+        b'data: {"a"',
+        b':1}\n\ndata: {"b":2}\n',
+        b'\ndata: [DONE]\n\ndata: {"late":3}\n\n',
+    ]
+    routes["key-b"] = 500
+
+    frames = run(collect(app._iter_openrouter_stream(MESSAGES)))
+    assert frames == [
+        b': OPENROUTER PROCESSING\n\ndata: {"a":1}\n\n',
+        b'data: {"b":2}\n\n',
+        app.SSE_DONE_FRAME,
+    ]
+    assert log["closed"] == ["key-a"]
+
+
+def test_heartbeat_fills_silence(app, monkeypatch):
+    monkeypatch.setattr(app, "CHAT_HEARTBEAT_INTERVAL", 0.02)
+
+    async def source():
+        yield b"data: 1\n\n"
+        await asyncio.sleep(0.07)
+        yield b"data: 2\n\n"
+
+    frames = run(collect(app.with_heartbeat(source())))
+    assert frames[0] == b"data: 1\n\n"
+    assert frames[-1] == b"data: 2\n\n"
+    assert set(frames[1:-1]) == {app.SSE_HEARTBEAT_FRAME}
+    assert len(frames) >= 3
+
+
+def test_disconnect_closes_upstream(app, openrouter, monkeypatch):
+    routes, log = openrouter
+    routes["key-a"] = lambda: [b"data: 1\n\n", asyncio.sleep(5), b"data: 2\n\n"]
+    monkeypatch.setattr(app, "CHAT_HEARTBEAT_INTERVAL", 0.02)
+    cancelled = app.CHAT_STREAMS_CANCELLED.value()
+
+    class GoneRequest:
+        async def is_disconnected(self):
+            return True
+
+    frames = run(collect(app.with_heartbeat(app._iter_openrouter_stream(MESSAGES), GoneRequest())))
+    assert frames == [b"data: 1\n\n"]
+    assert log["closed"] == ["key-a"]
+    assert app.CHAT_STREAMS_CANCELLED.value() == cancelled + 1
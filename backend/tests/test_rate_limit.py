@@ -0,0 +1,52 @@
+import asyncio
+
+import pytest
+from starlette.responses import Response
+
+from middleware import MemoryRateLimitStore, RateLimitMiddleware
+
+
+def client_key(headers, key_header="x-forwarded-for", hops=1, client=("10.0.0.1", 1234)):
+    scope = {"headers": [(k.encode(), v.encode()) for k, v in headers], "client": client}
+    middleware = RateLimitMiddleware(None, {}, MemoryRateLimitStore(10), key_header=key_header, trusted_hops=hops)
+    return middleware.client_key(scope)
+
+
+def test_socket_address_without_key_header():
+    assert client_key([("x-forwarded-for", "1.1.1.1")], key_header="") == "10.0.0.1"
+
+
+@pytest.mark.parametrize("hops, header, expected", [
+    (1, "203.0.113.7", "203.0.113.7"),
+    # The client prepended a forged address; the proxy appended the real one
+    (1, "1.2.3.4, 203.0.113.7", "203.0.113.7"),
+    (2, "1.2.3.4, 203.0.113.7, 198.51.100.2", "203.0.113.7"),
+    (3, "203.0.113.7, 198.51.100.2", "203.0.113.7"),
+])
+def test_forwarded_for_uses_trusted_hop(hops, header, expected):
+    assert client_key([("x-forwarded-for", header)], hops=hops) == expected
+
+
+def test_forged_first_hop_does_not_get_new_bucket():
+    keys = {client_key([("x-forwarded-for", f"9.9.9.{i}, 203.0.113.7")]) for i in range(5)}
+    assert keys == {"203.0.113.7"}
+
+
+def test_trailing_slash_shares_bucket():
+    statuses = []
+
+    async def inner(scope, receive, send):
+        await Response(status_code=204)(scope, receive, send)
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            statuses.append(message["status"])
+
+    async def main():
+        middleware = RateLimitMiddleware(inner, {("POST", "/api/leads"): (2, 60)}, MemoryRateLimitStore(100))
+        for path in ("/api/leads", "/api/leads/", "/api/leads/"):
+            scope = {"type": "http", "method": "POST", "path": path, "headers": [], "client": ("10.0.0.1", 1)}
+            await middleware(scope, None, send)
+
+    asyncio.run(main())
+    assert statuses == [204, 204, 429]
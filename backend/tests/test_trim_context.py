@@ -0,0 +1,25 @@
+import pytest
+
+
+def total_tokens(server, messages):
+    return sum(server.estimate_tokens(m["content"]) + server.MESSAGE_TOKEN_OVERHEAD for m in messages)
+
+
+@pytest.mark.parametrize("budget", [200, 400, 730, 880, 1000])
+def test_trimmed_context_fits_budget(app, budget):
+    messages = [{"role": "system", "content": "Be brief."}]
+    messages += [{"role": "user" if i % 2 else "assistant", "content": "word " * 200} for i in range(12)]
+    messages.append({"role": "user", "content": "And now?"})
+
+    trimmed = app.trim_context(messages, budget, 100)
+    assert total_tokens(app, trimmed) <= budget
+    assert trimmed[0] == messages[0]
+    assert trimmed[-1] == messages[-1]
+
+
+def test_compacted_turn_is_marked(app):
+    messages = [{"role": "user", "content": "x" * 4000}, {"role": "user", "content": "latest"}]
+    trimmed = app.trim_context(messages, 200, 50)
+    assert len(trimmed) == 2
+    assert trimmed[0]["content"].endswith(" [...]")
+    assert total_tokens(app, trimmed) <= 200
@@ -0,0 +1,109 @@
+import asyncio
+
+import httpx
+import pytest
+
+
+def run_app(server, scenario):
+    """Run `scenario(client)` against the app with its lifespan (and write-behind queue) started."""
+    async def main():
+        async with server.lifespan(server.app):
+            transport = httpx.ASGITransport(app=server.app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+                return await scenario(client)
+    return asyncio.run(main())
+
+
+@pytest.fixture
+def write_behind(app, monkeypatch):
+    monkeypatch.setattr(app, "WRITE_BEHIND_ENABLED", True)
+    monkeypatch.setattr(app, "WRITE_BEHIND_FLUSH_MS", 20)
+    return app
+
+
+def test_existing_email_returns_stored_row(write_behind):
+    server = write_behind
+    stored = {"id": "existing-id", "email": "a@example.com", "source": "old",
+              "created_at": "2025-01-01T00:00:00+00:00"}
+    asyncio.run(server.storage.insert("leads", [stored]))
+
+    async def scenario(client):
+        return await client.post("/api/leads", json={"email": "a@example.com", "source": "new"})
+
+    resp = run_app(server, scenario)
+    assert resp.status_code == 201
+    assert resp.json()["id"] == "existing-id"
+    assert resp.json()["source"] == "old"
+
+
+def test_concurrent_identical_submits_share_one_row(write_behind):
+    server = write_behind
+
+    async def scenario(client):
+        return await asyncio.gather(*(
+            client.post("/api/newsletter", json={"email": "same@example.com"}) for _ in range(5)))
+
+    responses = run_app(server, scenario)
+    assert {r.status_code for r in responses} == {201}
+    assert len({r.json()["id"] for r in responses}) == 1
+    rows = asyncio.run(server.storage.fetch_page("newsletter", "created_at", 10))
+    assert [row["id"] for row in rows] == [responses[0].json()["id"]]
+    assert server.known_emails["newsletter"].get("same@example.com")["id"] == rows[0]["id"]
+
+
+def test_memory_durability_reports_unconfirmed(write_behind, monkeypatch):
+    server = write_behind
+    monkeypatch.setattr(server, "WRITE_BEHIND_DURABILITY", "memory")
+
+    async def scenario(client):
+        resp = await client.post("/api/leads", json={"email": "q@example.com"})
+        cached_before_flush = server.known_emails["leads"].get("q@example.com")
+        return resp, cached_before_flush
+
+    resp, cached_before_flush = run_app(server, scenario)
+    assert resp.status_code == 202
+    assert cached_before_flush is None
+    assert server.known_emails["leads"].get("q@example.com")["id"] == resp.json()["id"]
+
+
+def test_dropped_rows_are_not_cached(write_behind, monkeypatch):
+    server = write_behind
+    monkeypatch.setattr(server, "WRITE_BEHIND_DURABILITY", "memory")
+    monkeypatch.setattr(server, "WRITE_BEHIND_MAX_RETRIES", 0)
+
+    async def failing_insert_unique(*args, **kwargs):
+        raise RuntimeError("database unavailable")
+    monkeypatch.setattr(server.storage, "insert_unique", failing_insert_unique)
+
+    async def scenario(client):
+        return await client.post("/api/leads", json={"email": "lost@example.com"})
+
+    assert run_app(server, scenario).status_code == 202
+    assert server.known_emails["leads"].get("lost@example.com") is None
+
+
+@pytest.mark.parametrize("path, body", [
+    ("/api/status", {"client_name": "probe"}),
+    ("/api/orders-intent", {"price": 10, "currency": "BRL"}),
+    ("/api/checkout/start", {"price": 10, "currency": "BRL"}),
+])
+def test_memory_durability_inserts_answer_accepted(write_behind, monkeypatch, path, body):
+    server = write_behind
+    monkeypatch.setattr(server, "WRITE_BEHIND_DURABILITY", "memory")
+
+    async def scenario(client):
+        return await client.post(path, json=body)
+
+    assert run_app(server, scenario).status_code == 202
+
+
+@pytest.mark.parametrize("path, body, status", [
+    ("/api/status", {"client_name": "probe"}, 200),
+    ("/api/orders-intent", {"price": 10, "currency": "BRL"}, 201),
+    ("/api/checkout/start", {"price": 10, "currency": "BRL"}, 200),
+])
+def test_commit_durability_inserts_keep_their_status(write_behind, path, body, status):
+    async def scenario(client):
+        return await client.post(path, json=body)
+
+    assert run_app(write_behind, scenario).status_code == status
@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark das rotas do backend (backend/server.py) em processo
+Dispara requisições contra o `app` via transporte ASGI (sem rede), com
+armazenamento em memória (ou um PostgREST falso) e um OpenRouter falso, e
+mede requisições/s, latência p50/p95/p99 e memória alocada por requisição,
+além do custo de cada chamada de log no event loop.
+Os resultados são comparados com a baseline em scripts/bench_baseline.json
+
+Uso:
+    python scripts/bench_endpoints.py [--requests 300] [--concurrency 10]
+        [--storage memory|supabase-stub] [--log-mode queue|sync] [--route leads]
+        [--check] [--save]
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+import uuid
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Callable, List, NamedTuple, Optional
+
+BACKEND_DIR = Path(__file__).parent.parent / "backend"
+BASELINE_FILE = Path(__file__).parent / "bench_baseline.json"
+BASELINE_KEY = "endpoints"
+STUB_SUPABASE_URL = "http://supabase.stub"
+SEED_ROWS = 200
+CHAT_TOKENS = 20
+
+
+class Route(NamedTuple):
+    name: str
+    method: str
+    path: str
+    body: Optional[Callable[[int], dict]] = None
+    stream: bool = False
+
+
+ROUTES = [
+    Route("root", "GET", "/api/"),
+    Route("health", "GET", "/health"),
+    Route("checkout_config", "GET", "/api/checkout/config"),
+    Route("status_create", "POST", "/api/status", lambda i: {"client_name": f"bench-{i}"}),
+    Route("status_list", "GET", "/api/status?limit=100"),
+    Route("leads_create", "POST", "/api/leads", lambda i: {"email": f"lead{i}@example.com", "source": "bench"}),
+    Route("leads_list", "GET", "/api/leads?limit=100"),
+    Route("newsletter_create", "POST", "/api/newsletter", lambda i: {"email": f"news{i}@example.com"}),
+    Route("newsletter_list", "GET", "/api/newsletter?limit=100"),
+    Route("orders_intent_create", "POST", "/api/orders-intent", lambda i: {"price": 97.0, "currency": "BRL"}),
+    Route("orders_intent_list", "GET", "/api/orders-intent?limit=100"),
+    Route("checkout_start", "POST", "/api/checkout/start",
+          lambda i: {"price": 97.0, "currency": "BRL", "email": f"buyer{i}@example.com"}),
+    Route("chat_complete", "POST", "/api/chat/complete",
+          lambda i: {"messages": [{"role": "user", "content": f"pergunta {i}"}]}, stream=True),
+]
+
+
+def configure_env(storage: str, log_mode: str):
+    """Variáveis lidas no import do server: sem rate limit, sem cache de listas, chave falsa"""
+    os.environ["RATE_LIMIT_ENABLED"] = "false"
+    os.environ["LOG_QUEUE_ENABLED"] = "true" if log_mode == "queue" else "false"
+    os.environ["LIST_CACHE_TTL"] = "0"
+    os.environ["OPENROUTER_API_KEYS"] = "bench-key"
+    os.environ["CHAT_CACHE_ENABLED"] = "false"
+    os.environ.pop("ADMIN_API_KEY", None)
+    if storage == "memory":
+        os.environ["STORAGE_BACKEND"] = "memory"
+    else:
+        os.environ["STORAGE_BACKEND"] = "supabase"
+        os.environ["SUPABASE_URL"] = STUB_SUPABASE_URL
+        os.environ["SUPABASE_SERVICE_KEY"] = "bench"
+
+
+def seed_rows(table: str) -> List[dict]:
+    base = datetime(2025, 1, 1)
+    rows = []
+    for i in range(SEED_ROWS):
+        ts = (base + timedelta(seconds=i)).isoformat()
+        row_id = str(uuid.uuid4())
+        if table == "status_checks":
+            rows.append({"id": row_id, "client_name": f"seed-{i}", "timestamp": ts})
+        elif table == "order_intents":
+            rows.append({"id": row_id, "price": 97.0, "currency": "BRL", "note": None,
+                         "email": f"seed{i}@example.com", "created_at": ts})
+        else:
+            rows.append({"id": row_id, "email": f"seed{i}@example.com", "source": "seed", "created_at": ts})
+    return rows
+
+
+def postgrest_stub(httpx):
+    """PostgREST falso: escritas ecoam o corpo, leituras devolvem as linhas semeadas"""
+    tables = {t: seed_rows(t) for t in ("leads", "newsletter", "order_intents", "status_checks")}
+
+    def handler(request):
+        table = request.url.path.rsplit("/", 1)[-1]
+        if request.method == "POST":
+            if "return=minimal" in request.headers.get("prefer", ""):
+                return httpx.Response(201)
+            body = json.loads(request.content)
+            return httpx.Response(201, json=body if isinstance(body, list) else [body])
+        rows = tables.get(table, [])
+        limit = int(request.url.params.get("limit", len(rows)))
+        return httpx.Response(200, json=rows[:limit])
+
+    return httpx.MockTransport(handler)
+
+
+def openrouter_stub(httpx):
+    """OpenRouter falso: stream SSE de CHAT_TOKENS tokens, e 200 na checagem de chave"""
+    frame = b'data: {"choices":[{"delta":{"content":"ok "}}]}\n\n'
+    body = b": OPENROUTER PROCESSING\n\n" + frame * CHAT_TOKENS + b"data: [DONE]\n\n"
+
+    def handler(request):
+        if request.url.path.endswith("/chat/completions"):
+            return httpx.Response(200, headers={"content-type": "text/event-stream"}, content=body)
+        return httpx.Response(200, json={"data": {}})
+
+    return httpx.MockTransport(handler)
+
+
+async def send(client, route: Route, i: int):
+    kwargs = {"json": route.body(i)} if route.body else {}
+    if route.stream:
+        async with client.stream(route.method, route.path, **kwargs) as resp:
+            async for _ in resp.aiter_raw():
+                pass
+    else:
+        resp = await client.request(route.method, route.path, **kwargs)
+    if resp.status_code >= 400:
+        raise RuntimeError(f"{route.method} {route.path} -> {resp.status_code}")
+
+
+async def measure_route(client, route: Route, counter, requests: int, concurrency: int, alloc_samples: int) -> dict:
+    for _ in range(max(concurrency, 10)):
+        await send(client, route, next(counter))
+
+    latencies: List[float] = []
+    remaining = itertools.count()
+
+    async def worker():
+        while next(remaining) < requests:
+            t0 = time.perf_counter()
+            await send(client, route, next(counter))
+            latencies.append(time.perf_counter() - t0)
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - t0
+
+    # Pico de memória alocada durante uma requisição (tracemalloc deixa tudo mais lento,
+    # por isso roda numa passada separada e sequencial)
+    allocs = []
+    tracemalloc.start()
+    try:
+        for _ in range(alloc_samples):
+            before = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            await send(client, route, next(counter))
+            allocs.append(tracemalloc.get_traced_memory()[1] - before)
+    finally:
+        tracemalloc.stop()
+
+    cuts = statistics.quantiles(latencies, n=100)
+    return {
+        "rps": round(requests / elapsed, 1),
+        "p50_ms": round(cuts[49] * 1000, 3),
+        "p95_ms": round(cuts[94] * 1000, 3),
+        "p99_ms": round(cuts[98] * 1000, 3),
+        "alloc_kib": round(statistics.median(allocs) / 1024, 1),
+    }
+
+
+def measure_logging(server, calls: int = 20000) -> float:
+    """Microssegundos por logger.info no thread do loop (com tag de rota e amostragem)"""
+    token = server._log_route.set("/api/leads")
+    try:
+        t0 = time.perf_counter()
+        for i in range(calls):
+            server.logger.info("Lead already exists: %s", "leitor@example.com")
+        return (time.perf_counter() - t0) / calls * 1e6
+    finally:
+        server._log_route.reset(token)
+
+
+async def run(args) -> dict:
+    sys.path.insert(0, str(BACKEND_DIR))
+    import httpx
+    import server
+
+    # Mantém o custo de formatação e escrita dos logs, mas sem poluir o terminal
+    server.log_handler.setStream(open(os.devnull, "w"))
+
+    server._openrouter_client = httpx.AsyncClient(transport=openrouter_stub(httpx))
+    if args.storage == "memory":
+        for table in ("leads", "newsletter", "order_intents", "status_checks"):
+            await server.storage.insert(table, seed_rows(table))
+    else:
+        client = server.init_supabase()
+        client.session = httpx.AsyncClient(base_url=f"{STUB_SUPABASE_URL}/rest/v1",
+                                           headers=client.session.headers, transport=postgrest_stub(httpx))
+
+    routes = [r for r in ROUTES if not args.route or args.route in r.name]
+    counter = itertools.count()
+    results = {}
+    async with server.lifespan(server.app):
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=server.app),
+                                     base_url="http://bench") as client:
+            for route in routes:
+                results[route.name] = await measure_route(
+                    client, route, counter, args.requests, args.concurrency, args.alloc_samples)
+
+    # Por último, para a fila de logs cheia não disputar o GIL com as rotas
+    log_us = measure_logging(server)
+    print(f"logging: {args.log_mode} ({server.LOG_FORMAT}), {log_us:.2f} us por chamada no loop")
+    return results
+
+
+def load_baseline() -> dict:
+    if BASELINE_FILE.exists():
+        return json.loads(BASELINE_FILE.read_text(encoding="utf-8"))
+    return {}
+
+
+def compare(name: str, result: dict, base: Optional[dict], tolerance: float) -> List[str]:
+    """Métricas que pioraram além da tolerância (rps menor, p95 ou alocação maiores)"""
+    if not base:
+        return []
+    worse = []
+    if result["rps"] < base["rps"] * (1 - tolerance):
+        worse.append(f"{name}.rps")
+    if result["p95_ms"] > base["p95_ms"] * (1 + tolerance):
+        worse.append(f"{name}.p95_ms")
+    if result["alloc_kib"] > base["alloc_kib"] * (1 + tolerance) + 1:
+        worse.append(f"{name}.alloc_kib")
+    return worse
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--requests", type=int, default=300, help="requisições medidas por rota")
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--alloc-samples", type=int, default=30)
+    parser.add_argument("--storage", choices=("memory", "supabase-stub"), default="memory")
+    parser.add_argument("--log-mode", choices=("queue", "sync"), default="queue",
+                        help="logs via fila + thread (padrão) ou escrita síncrona no loop")
+    parser.add_argument("--route", help="só as rotas cujo nome contém este texto")
+    parser.add_argument("--check", action="store_true",
+                        help="falha (exit 1) se alguma rota piorar além da tolerância")
+    parser.add_argument("--save", action="store_true", help="grava os resultados como nova baseline")
+    parser.add_argument("--tolerance", type=float, default=0.3, help="piora relativa aceita (0.3 = 30%%)")
+    args = parser.parse_args()
+
+    configure_env(args.storage, args.log_mode)
+    results = asyncio.run(run(args))
+
+    baseline_all = load_baseline()
+    variant = f"{args.storage}/{args.log_mode}"
+    baseline = baseline_all.get(BASELINE_KEY, {}).get(variant, {})
+    print(f"armazenamento: {args.storage}, {args.requests} requisições/rota, concorrência {args.concurrency}")
+    print(f"{'rota':<22}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'KiB/req':>9}{'vs base':>9}")
+    regressions = []
+    for name, r in results.items():
+        base = baseline.get(name)
+        change = f"{r['rps'] / base['rps'] - 1:+.0%}" if base else "-"
+        print(f"{name:<22}{r['rps']:>9.0f}{r['p50_ms']:>9.2f}{r['p95_ms']:>9.2f}{r['p99_ms']:>9.2f}"
+              f"{r['alloc_kib']:>9.1f}{change:>9}")
+        regressions += compare(name, r, base, args.tolerance)
+
+    if args.save:
+        baseline_all.setdefault(BASELINE_KEY, {}).setdefault(variant, {}).update(results)
+        BASELINE_FILE.write_text(json.dumps(baseline_all, indent=2) + "\n", encoding="utf-8")
+        print(f"baseline gravada em {BASELINE_FILE}")
+    if args.check and regressions:
+        print(f"✗ regressão acima de {args.tolerance:.0%}: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
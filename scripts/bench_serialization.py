@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmark de serialização do backend (backend/server.py)
+Compara o custo por linha do caminho antigo (modelo pydantic por linha +
+revalidação do response_model + jsonable_encoder/json.dumps) com o caminho
+atual (TypeAdapter em cache + dump_json / orjson)
+
+Uso:
+    python scripts/bench_serialization.py [--rows 1000] [--repeat 20]
+"""
+
+import argparse
+import json
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import List
+
+BACKEND_DIR = Path(__file__).parent.parent / "backend"
+sys.path.insert(0, str(BACKEND_DIR))
+
+from fastapi.encoders import jsonable_encoder  # noqa: E402
+from pydantic import TypeAdapter  # noqa: E402
+
+import server  # noqa: E402
+
+
+def make_rows(n: int) -> List[dict]:
+    """Linhas no formato devolvido pelo PostgREST (datas como string ISO)"""
+    base = datetime(2025, 1, 1)
+    return [
+        {
+            "id": str(uuid.uuid4()),
+            "email": f"leitor{i}@example.com",
+            "source": "landing",
+            "created_at": (base + timedelta(seconds=i)).isoformat() + "+00:00",
+        }
+        for i in range(n)
+    ]
+
+
+def legacy_list(rows: List[dict]) -> bytes:
+    """Caminho antigo: Lead(**item) por linha e depois o response_model do FastAPI"""
+    models = [server.Lead(**item) for item in rows]
+    validated = TypeAdapter(List[server.Lead]).validate_python([m.model_dump() for m in models])
+    return json.dumps(jsonable_encoder(validated)).encode()
+
+
+def current_list(rows: List[dict]) -> bytes:
+    return server.encode_rows(server.Lead, rows)
+
+
+def legacy_write() -> bytes:
+    """Caminho antigo de escrita: .dict() + isoformat manual + response_model"""
+    lead = server.Lead(email="leitor@example.com", source="landing")
+    data = lead.dict()
+    data["created_at"] = data["created_at"].isoformat()
+    validated = TypeAdapter(server.Lead).validate_python(lead.model_dump())
+    return json.dumps(jsonable_encoder(validated)).encode()
+
+
+def current_write() -> bytes:
+    data = server.Lead(email="leitor@example.com", source="landing").model_dump(mode="json")
+    return server.dumps(data)
+
+
+def bench(fn, repeat: int, *args) -> float:
+    """Melhor tempo (s) entre `repeat` execuções"""
+    fn(*args)
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn(*args)
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    rows = make_rows(args.rows)
+    assert json.loads(legacy_list(rows)) == json.loads(current_list(rows))
+
+    print(f"encoder: {'orjson' if server.orjson is not None else 'json (stdlib)'}")
+    print(f"{'caminho':<28}{'antes':>12}{'depois':>12}{'ganho':>9}")
+
+    before = bench(legacy_list, args.repeat, rows) / args.rows * 1e6
+    after = bench(current_list, args.repeat, rows) / args.rows * 1e6
+    print(f"{'lista (us/linha)':<28}{before:>12.2f}{after:>12.2f}{before / after:>8.1f}x")
+
+    before = bench(lambda: [legacy_write() for _ in range(args.rows)], args.repeat) / args.rows * 1e6
+    after = bench(lambda: [current_write() for _ in range(args.rows)], args.repeat) / args.rows * 1e6
+    print(f"{'escrita (us/requisicao)':<28}{before:>12.2f}{after:>12.2f}{before / after:>8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
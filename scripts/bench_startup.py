@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark de cold start do backend (backend/server.py)
+Mede, em processos novos, o tempo de `import server` e o tempo até a primeira
+resposta (subir o uvicorn e receber 200 em /health), e compara o melhor tempo
+de cada métrica com a baseline em scripts/bench_baseline.json
+
+Uso:
+    python scripts/bench_startup.py [--runs 5] [--check] [--save]
+"""
+
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+from pathlib import Path
+
+BACKEND_DIR = Path(__file__).parent.parent / "backend"
+BASELINE_FILE = Path(__file__).parent / "bench_baseline.json"
+BASELINE_KEY = "startup"
+
+IMPORT_SNIPPET = (
+    "import time; t0 = time.perf_counter(); import server; "
+    "print(time.perf_counter() - t0)"
+)
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def measure_import() -> float:
+    """Segundos de `import server` num interpretador novo"""
+    out = subprocess.run(
+        [sys.executable, "-c", IMPORT_SNIPPET],
+        cwd=BACKEND_DIR, capture_output=True, text=True, check=True,
+    )
+    return float(out.stdout.strip().splitlines()[-1])
+
+
+def measure_first_response(timeout: float = 30.0) -> float:
+    """Segundos entre iniciar o uvicorn e o primeiro 200 em /health"""
+    port = free_port()
+    url = f"http://127.0.0.1:{port}/health"
+    t0 = time.perf_counter()
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "server:app", "--host", "127.0.0.1", "--port", str(port),
+         "--log-level", "warning"],
+        cwd=BACKEND_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        while time.perf_counter() - t0 < timeout:
+            try:
+                with urllib.request.urlopen(url, timeout=1) as resp:
+                    if resp.status == 200:
+                        return time.perf_counter() - t0
+            except OSError:
+                pass
+            if proc.poll() is not None:
+                raise RuntimeError("uvicorn saiu antes de responder")
+            time.sleep(0.01)
+        raise RuntimeError(f"sem resposta em {timeout}s")
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+def load_baseline() -> dict:
+    if BASELINE_FILE.exists():
+        return json.loads(BASELINE_FILE.read_text(encoding="utf-8"))
+    return {}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--check", action="store_true",
+                        help="falha (exit 1) se alguma métrica piorar além da tolerância")
+    parser.add_argument("--save", action="store_true", help="grava os resultados como nova baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="piora relativa aceita (0.25 = 25%%)")
+    args = parser.parse_args()
+
+    # Sem credenciais: mede só o custo do próprio backend, sem rede
+    os.environ.pop("SUPABASE_URL", None)
+    os.environ.pop("OPENROUTER_API_KEYS", None)
+
+    # Melhor de N execuções: o ruído da máquina só piora o tempo, nunca melhora
+    imports = [measure_import() for _ in range(args.runs)]
+    firsts = [measure_first_response() for _ in range(args.runs)]
+    results = {
+        "import_s": round(min(imports), 4),
+        "first_response_s": round(min(firsts), 4),
+    }
+
+    baseline_all = load_baseline()
+    baseline = baseline_all.get(BASELINE_KEY, {})
+    print(f"{'métrica':<22}{'melhor':>10}{'baseline':>10}{'variação':>10}")
+    regressions = []
+    for name, value in results.items():
+        base = baseline.get(name)
+        if base:
+            change = (value - base) / base
+            print(f"{name:<22}{value:>10.3f}{base:>10.3f}{change:>+9.0%}")
+            if change > args.tolerance:
+                regressions.append(name)
+        else:
+            print(f"{name:<22}{value:>10.3f}{'-':>10}{'-':>10}")
+
+    if args.save:
+        baseline_all[BASELINE_KEY] = results
+        BASELINE_FILE.write_text(json.dumps(baseline_all, indent=2) + "\n", encoding="utf-8")
+        print(f"baseline gravada em {BASELINE_FILE}")
+    if args.check and regressions:
+        print(f"✗ regressão acima de {args.tolerance:.0%}: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()